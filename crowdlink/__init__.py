@@ -121,6 +121,11 @@ def create_app(config='/application.json'):
     app.register_blueprint(api.api, url_prefix='/api')
     app.register_blueprint(views.main)
 
+    # compile the serializer of every models join profiles up front
+    from .serialize import compile_all
+    compile_all(cls for cls in db.Model._decl_class_registry.values()
+                if isinstance(cls, type))
+
     # tell the session manager how to access the user object
     @lm.user_loader
     def user_loader(id):
@@ -1,8 +1,66 @@
 import yaml
+import six
 from . import root
 
 from lever import build_acl
 
 
+class CompiledACL(dict):
+    """ The role to allowed actions mapping of one type, as built by
+    build_acl, with every action interned to a bit. Each role becomes an
+    integer mask, so checking a permission is a handful of ORs and an AND.
+    The mask of every combination of roles seen is memoized, as is the set of
+    actions each mask decodes to """
+
+    def __init__(self, roles):
+        super(CompiledACL, self).__init__(roles)
+        actions = sorted(set().union(*roles.values())) if roles else []
+        self.actions = tuple(actions)
+        self.bits = dict((action, 1 << i) for i, action in enumerate(actions))
+        self.role_masks = dict((role, self.encode(keys))
+                               for role, keys in six.iteritems(roles))
+        self._combos = {}
+        self._decoded = {}
+
+    def encode(self, actions):
+        """ The mask of a collection of actions, unknown ones are ignored """
+        mask = 0
+        for action in actions:
+            mask |= self.bits.get(action, 0)
+        return mask
+
+    def mask(self, roles):
+        """ The mask of everything the given roles allow """
+        key = tuple(roles)
+        mask = self._combos.get(key)
+        if mask is None:
+            mask = 0
+            for role in key:
+                mask |= self.role_masks.get(role, 0)
+            if len(self._combos) > 1024:
+                self._combos.clear()
+            self._combos[key] = mask
+        return mask
+
+    def permits(self, roles, action):
+        return bool(self.mask(roles) & self.bits.get(action, 0))
+
+    def allowed(self, mask):
+        """ The actions of a mask, as a frozenset shared between callers """
+        actions = self._decoded.get(mask)
+        if actions is None:
+            actions = frozenset(action for action in self.actions
+                                if mask & self.bits[action])
+            if len(self._decoded) > 1024:
+                self._decoded.clear()
+            self._decoded[mask] = actions
+        return actions
+
+
+def compile_acl(acl):
+    """ Compiles the output of build_acl into a CompiledACL per type """
+    return dict((typ, CompiledACL(roles)) for typ, roles in six.iteritems(acl))
+
+
 acl_yaml = yaml.load(open(root + '/crowdlink/acl.yaml'))
-acl = build_acl(acl_yaml)
+acl = compile_acl(build_acl(acl_yaml))
@@ -1,16 +1,24 @@
-from flask import Blueprint, current_app, jsonify
+from flask import (Blueprint, Response, current_app, jsonify, request,
+                   stream_with_context)
 from flask.ext.login import login_required, logout_user, current_user
 from flask.ext.oauthlib.client import OAuthException
 
 from pprint import pformat
-from lever import API, ModelBasedACL, LeverException, preprocess
+from lever import (API, ModelBasedACL, LeverException, LeverSyntaxError,
+                   preprocess)
+from lever.base import LeverNotFound
 import six
 import sys
 from .oauth import oauth_retrieve, oauth_from_session
 from .models import User, Project, Task, Email, Comment, Thing
+from .model_lib import (EventFeed, decode_cursor, prime_acl, eager_options,
+                        join_versions)
+from .serialize import get_joined
+from .stream import event_stream
 
-from . import oauth, db
+from . import oauth, db, response_cache
 
+import hashlib
 import sqlalchemy
 
 
@@ -33,7 +41,7 @@ def api_error_handler(exc):
         msg = str(e)
         end_user = e.end_user
         extra = e.extra
-        del extra['tb']
+        extra.pop('tb', None)
 
     # OAuth Exceptions
     except oauth.OAuthAlreadyLinked:
@@ -108,13 +116,210 @@ def oauth_user_data():
     return jsonify(success=False, error='oauth_missing_token')
 
 
+@api.route("/feed", methods=['GET'])
+def feed():
+    """ Pages backwards through a Things feed. Each returned event carries a
+    cursor, pass the last one back as before to get the next page """
+    thing_id = request.args.get('id', getattr(current_user, 'id', None))
+    try:
+        thing_id = int(thing_id)
+    except (TypeError, ValueError):
+        raise LeverSyntaxError("Invalid id given")
+    feed = request.args.get('feed', 'events')
+    before = request.args.get('before')
+    if before is not None:
+        try:
+            decode_cursor(before)
+        except ValueError:
+            raise LeverSyntaxError("Invalid feed cursor given")
+    max_size = current_app.config.get('feed_max_page_size', 100)
+    pg_size = request.args.get(
+        'pg_size', current_app.config.get('feed_page_size', 20), type=int)
+    pg_size = max(1, min(pg_size, max_size))
+
+    thing = Thing.query.filter_by(id=thing_id).first()
+    if thing is None or not isinstance(getattr(type(thing), feed, None),
+                                       EventFeed):
+        raise LeverNotFound("Could not find that feed")
+    if not thing.can('view_' + feed):
+        raise LeverException("You don't have permission to do that",
+                             code=403)
+
+    events = thing.feed_page(feed, before=before, limit=pg_size)
+
+    # merged feeds can come up short of a full page, so keep handing out
+    # cursors until a page comes back empty
+    cursor = events[-1].cursor if events else None
+    return jsonify(success=True,
+                   objects=[event.to_json() for event in events],
+                   cursor=cursor)
+
+
+@api.route("/user/unread", methods=['GET', 'POST'])
+@login_required
+def unread():
+    """ How many events have reached the current users feed since they last
+    read it. Cheap enough to poll, it only reads one row. POSTing marks the
+    feed as read, up to the cursor before if one is given """
+    if request.method == 'POST':
+        before = (request.get_json(silent=True) or {}).get('before')
+        if before is not None:
+            try:
+                decode_cursor(before)
+            except (AttributeError, ValueError):
+                raise LeverSyntaxError("Invalid feed cursor given")
+        state = current_user.mark_seen('events', before=before)
+        db.session.commit()
+    else:
+        state = current_user.feed_state('events')
+    return jsonify(success=True, unread=state.unread, seen=state.seen)
+
+
+@api.route("/feed/stream", methods=['GET'])
+@login_required
+def feed_stream():
+    """ Pushes entries delivered to the current users feed as server-sent
+    events. EventSource sends back the id of the last event it got when it
+    reconnects, and the stream picks up from there. Every open stream holds
+    on to a worker, so it's only served when feed_stream_enabled is set,
+    which needs uwsgi running in gevent mode """
+    if not current_app.config.get('feed_stream_enabled', False):
+        raise LeverNotFound("Live feed streaming isn't enabled")
+    last = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if last is not None:
+        try:
+            decode_cursor(last)
+        except ValueError:
+            raise LeverSyntaxError("Invalid feed cursor given")
+    events = event_stream(
+        current_user.id, 'events', last=last,
+        keepalive=current_app.config.get('feed_stream_keepalive', 15),
+        duration=current_app.config.get('feed_stream_duration', 50))
+    return Response(stream_with_context(events),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@api.route("/metrics/response_cache", methods=['GET'])
+def response_cache_metrics():
+    """ Hits and misses of the anonymous page cache across every worker """
+    return jsonify(success=True, **response_cache.stats())
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 class APIBase(ModelBasedACL, API):
     session = db.session
     create_method = 'create'
+    join = None
+    # the name anonymous pages of the model are cached under, None to not
+    # cache them
+    cache_endpoint = None
+
+    def get(self):
+        key = response_cache.page_key(self.cache_endpoint)
+        if key is not None:
+            cached = response_cache.fetch(key)
+            if cached is not None:
+                body, etag = cached
+                if etag is not None and etag in request.if_none_match:
+                    return not_modified(etag)
+                response = Response(body, mimetype='application/json')
+                if etag is not None:
+                    response.set_etag(etag)
+                return response
+        response = self.versioned_get()
+        if key is not None and response.status_code == 200:
+            response_cache.store_body(
+                key, (response.get_data(), response.get_etag()[0]))
+        return response
+
+    def versioned_get(self):
+        """ lever's get, except joins with a version answer conditional
+        requests from the versions of the objects loaded before anything is
+        serialized """
+        # convert args to a real dictionary that can be popped
+        self.params = dict((one, two) for one, two in six.iteritems(request.args))
+        for method in self._pre_method.get('get', []):
+            method(self)
+        join = self.params.pop('join_prof', 'standard_join')
+        obj = self.get_obj()
+        if obj:  # if a int primary key is passed
+            objs = [obj]
+        else:
+            query = self.search()
+            one = self.params.pop('__one', None)
+            if one:
+                objs = [query.one()]
+            else:
+                objs = self.paginate(query=query)
+        for obj in objs:
+            assert self.can(obj, 'view_' + join), "Can't view that object with join " + join
+
+        etag = self.etag(objs, join)
+        if etag is not None and etag in request.if_none_match:
+            return not_modified(etag)
+
+        retval = dict(success=True, objects=get_joined(objs, join))
+        for method in self._post_method.get('get', []):
+            method(self, retval)
+        response = jsonify(**retval)
+        if etag is not None:
+            response.set_etag(etag)
+        return response
+
+    def etag(self, objs, join):
+        """ Built from the versions of every Thing the join reaches, and who
+        is asking since the join can show their roles, votes and the like.
+        None if the join isn't covered by versions """
+        if join not in self.model.versioned_joins:
+            return None
+        key = (join,
+               getattr(current_user, 'id', None),
+               sorted(current_user.global_roles()),
+               join_versions(objs, join))
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+    @preprocess(method='get')
+    def record_join(self):
+        self.join = self.params.get('join_prof', 'standard_join')
+
+    def get_obj(self):
+        pkey = self.params.pop(self.pkey_val, None)
+        if not pkey:  # if a int primary key is passed
+            return False
+        query = self.session.query(self.model)
+        if self.join:
+            # load everything the join walks through with the object itself
+            query = query.options(*eager_options(self.model, self.join))
+        obj = query.filter(self.pkey == pkey).one()
+        if self.join:
+            prime_acl([obj], self.join)
+        return obj
+
+    def search(self, query=None):
+        query = super(APIBase, self).search(query=query)
+        if self.join:
+            query = query.options(*eager_options(self.model, self.join))
+        return query
+
+    def paginate(self, query=None):
+        # the page gets serialized as a list, so the acls of everything on it
+        # can be worked out together
+        objs = list(super(APIBase, self).paginate(query=query))
+        if self.join:
+            prime_acl(objs, self.join)
+        return objs
 
 
 class UserAPI(APIBase):
     model = User
+    cache_endpoint = 'user'
 
 
 class EmailAPI(APIBase):
@@ -123,10 +328,12 @@ class EmailAPI(APIBase):
 
 class ProjectAPI(APIBase):
     model = Project
+    cache_endpoint = 'project'
 
 
 class TaskAPI(APIBase):
     model = Task
+    cache_endpoint = 'task'
     @preprocess(action='create')
     def create_hook(self):
         # do logic to pick out the parent from the database based on parent
@@ -0,0 +1,196 @@
+""" Benchmarks for the hot paths of the app. Each one is wired up as a manage.py
+command and prints its own timings. Anything written to the database is
+rolled back when the benchmark finishes. """
+from flask import current_app
+from lever import get_joined
+
+from . import db, serialize
+from .models import Thing, User, Project, Task
+from .model_lib import Subscription
+from .events import TaskNotif
+from .model_lib import encode_event, decode_event
+
+import datetime
+import json
+import lever.base
+import sys
+import time
+
+
+def timed(func, rounds):
+    """ Runs func rounds times and returns the best time in seconds """
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        func()
+        took = time.time() - start
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def make_users(count, prefix='bench'):
+    """ Creates users with core inserts since User.create is far too slow to
+    make thousands of them. Returns their ids """
+    ids = []
+    things = Thing.__table__
+    users = User.__table__
+    for start in range(0, count, 5000):
+        size = min(5000, count - start)
+        res = db.session.execute(
+            things.insert().values([{'type': 'User'}] * size)
+            .returning(things.c.id))
+        chunk = [row[0] for row in res.fetchall()]
+        db.session.execute(users.insert().values(
+            [{'id': uid, 'username': '{}{}'.format(prefix, uid)}
+             for uid in chunk]))
+        ids += chunk
+    return ids
+
+
+def bench_delivery(subscribers=10000, rounds=5):
+    """ Times delivering one event to a project with the given number of
+    subscribers, all of them pushed to """
+    threshold = current_app.config.get('fanout_pull_threshold')
+    current_app.config['fanout_pull_threshold'] = None
+    try:
+        owner = User(username='bench_owner')
+        project = Project(owner=owner, name='Bench', url_key='bench')
+        db.session.add(project)
+        db.session.flush()
+        db.session.execute(Subscription.__table__.insert().values(
+            [{'subscriber_id': uid, 'subscribee_id': project.id}
+             for uid in make_users(subscribers)]))
+
+        def deliver():
+            notif = TaskNotif(time=datetime.datetime.utcnow(),
+                              uname='bench_owner',
+                              uavatar='',
+                              user_p='/u/0',
+                              pname=project.name,
+                              proj_p=project.get_dur_url,
+                              iname='Benchmark task',
+                              task_p='/i/0')
+            notif.send_event((project, 'subscribers'))
+
+        best = timed(deliver, rounds)
+        print("Delivered to {} subscribers in {:.1f} ms, {:.1f} ms per 10k"
+              .format(subscribers, best * 1000,
+                      best * 1000 * 10000 / subscribers))
+    finally:
+        db.session.rollback()
+        current_app.config['fanout_pull_threshold'] = threshold
+
+
+def make_events(count):
+    """ Builds count TaskNotifs shaped like the ones the site generates """
+    # the same shape of url as User.avatar
+    avatar = ("http://www.gravatar.com/avatar/{}?d=http%3A%2F%2F127.0.0.1"
+              "%2Fstatic%2Fimg%2Fno_avatar.jpg".format('0' * 32))
+    return [TaskNotif(time=datetime.datetime.utcnow(),
+                      uname='bench_owner',
+                      uavatar=avatar,
+                      user_p='/u/{}'.format(i),
+                      pname='Benchmark project',
+                      proj_p='/p/{}'.format(i),
+                      iname='Benchmark task {}'.format(i),
+                      task_p='/i/{}'.format(i))
+            for i in range(count)]
+
+
+def bench_event_encoding(count=10000, rounds=5):
+    """ Compares the stored size and decode time of events in the old JSON
+    encoding against the compact one, with and without compression """
+    events = make_events(count)
+    encodings = [
+        ('json', [json.dumps(e.to_dict()).encode('utf8') for e in events]),
+        ('packed', [encode_event(e, compress=False) for e in events]),
+        ('packed+zlib', [encode_event(e, compress=True) for e in events])]
+    for name, raws in encodings:
+        size = sum(len(raw) for raw in raws)
+        best = timed(lambda: [decode_event(raw) for raw in raws], rounds)
+        print("{:<12} {:>6.1f} bytes/event, {:.2f} us/decode"
+              .format(name, float(size) / count, best * 1000000 / count))
+
+
+def bench_event_objects(count=10000, rounds=5):
+    """ Compares the memory held by each decoded event and the time taken to
+    serialize them against plain objects carrying an instance dict """
+    class Plain(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    events = make_events(count)
+    plain = [Plain(**e.to_dict()) for e in events]
+    print("slots  {:>6.1f} bytes/event".format(
+        float(sum(sys.getsizeof(e) for e in events)) / count))
+    print("dict   {:>6.1f} bytes/event".format(
+        float(sum(sys.getsizeof(e) + sys.getsizeof(e.__dict__)
+                  for e in plain)) / count))
+
+    best = timed(lambda: [e.to_json() for e in events], rounds)
+    print("to_json    {:.2f} us/event".format(best * 1000000 / count))
+    best = timed(lambda: get_joined(events), rounds)
+    print("get_joined {:.2f} us/event".format(best * 1000000 / count))
+
+
+def bench_acl(checks=100000, rounds=5):
+    """ Compares a permission check and a user_acl lookup done by unioning
+    each roles set of actions against the compiled bitmasks """
+    acl = Task.acl
+    roles = ['project_maintainer', 'creator', 'user']
+    actions = ['edit_title', 'view_page_join', 'delete', 'action_vote']
+
+    def union(roles):
+        allowed = set()
+        for role in roles:
+            allowed |= acl.get(role, set())
+        return allowed
+
+    def sets_can():
+        for i in range(checks):
+            actions[i % 4] in union(roles)
+
+    def compiled_can():
+        for i in range(checks):
+            acl.permits(roles, actions[i % 4])
+
+    def sets_acl():
+        for _ in range(checks):
+            union(roles)
+
+    def compiled_acl():
+        for _ in range(checks):
+            set(acl.allowed(acl.mask(roles)))
+
+    for name, func in [('sets can', sets_can),
+                       ('compiled can', compiled_can),
+                       ('sets user_acl', sets_acl),
+                       ('compiled user_acl', compiled_acl)]:
+        best = timed(func, rounds)
+        print("{:<18} {:.3f} us/check".format(name, best * 1000000 / checks))
+
+
+def bench_serializers(count=10000, rounds=5):
+    """ Compares serializing tasks through lever's get_joined with the
+    compiled serializers, for each of the tasks join profiles """
+    owner = User(username='bench_owner')
+    project = Project(owner=owner, name='Bench', url_key='bench')
+    tasks = [Task(title='Benchmark task {}'.format(i), project=project,
+                  creator=owner, status='Discussion', votes=i,
+                  created_at=datetime.datetime.utcnow())
+             for i in range(count)]
+    # the objects are never added to the session, so nothing gets written
+    with current_app.test_request_context():
+        for prof in ['brief_join', 'disp_join', 'standard_join']:
+            lever.base.get_joined = serialize._reflect
+            try:
+                best = timed(lambda: [serialize._reflect(t, prof)
+                                      for t in tasks], rounds)
+            finally:
+                lever.base.get_joined = serialize.get_joined
+            print("{:<14} get_joined {:.2f} us/task".format(
+                prof, best * 1000000 / count))
+            best = timed(lambda: serialize.get_joined(tasks, prof), rounds)
+            print("{:<14} compiled   {:.2f} us/task".format(
+                prof, best * 1000000 / count))
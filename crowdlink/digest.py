@@ -0,0 +1,127 @@
+""" Periodic digest emails. Rather than an email going out for every event,
+each user who wants one gets a summary of what reached their events feed
+since the last digest, daily or weekly. Every batch of users due a digest is
+sent over a single mail server connection """
+from flask import current_app, url_for
+from jinja2 import Markup, escape
+from sqlalchemy.orm import joinedload
+
+from . import db
+from .models import User, DIGEST_PERIODS
+from .model_lib import FeedEntry, decode_cursor
+from .mail import EmailBase, send_bulk
+
+import datetime
+import sqlalchemy
+
+
+class DigestEmail(EmailBase):
+    """ A summary of the newest events in a users feed """
+
+    html_template = "email/base.html"
+    subject = 'Your Crowdlink.io digest'
+
+    def __init__(self, user, events, total):
+        super(DigestEmail, self).__init__()
+        root = url_for('main.angular_root', _external=True)
+        lines = []
+        for event in events:
+            line = event.digest_line()
+            if line is None:
+                continue
+            text, path = line
+            lines.append(Markup('<a href="{}#{}">{}</a>').format(
+                root, path, text))
+        if total > len(events):
+            lines.append(escape("and {} more".format(total - len(events))))
+
+        self.html_context = dict(
+            title='Here is what happened since your last digest, {}'
+            .format(user.username),
+            one_button_row=True,
+            body=Markup('<br>').join(lines),
+            button_one_text='See your feed',
+            button_one_link=root,
+            sincere=True)
+
+
+def due_clause(now):
+    """ Users whose last digest is older than the period they picked. Users
+    who never chose get the default daily digest """
+    clauses = []
+    for name, period in DIGEST_PERIODS.items():
+        if period is None:
+            continue
+        setting = User._digest == name
+        if name == 'daily':
+            setting = sqlalchemy.or_(setting, User._digest.is_(None))
+        clauses.append(sqlalchemy.and_(
+            setting, sqlalchemy.or_(User.digest_time.is_(None),
+                                    User.digest_time <= now - period)))
+    return sqlalchemy.or_(*clauses)
+
+
+def digest_entries(user, now, limit):
+    """ The newest entries in the users feed since their last digest, and how
+    many there are in total. Without a previous digest that's everything
+    from the last period """
+    entries = FeedEntry.query.filter_by(owner_id=user.id, feed='events')
+    if user.digest_cursor:
+        time, event_id = decode_cursor(user.digest_cursor)
+        entries = entries.filter(
+            sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) >
+            sqlalchemy.tuple_(time, event_id))
+    else:
+        entries = entries.filter(
+            FeedEntry.time > now - DIGEST_PERIODS[user.digest])
+    total = entries.count()
+    if not total:
+        return [], 0
+    newest = (entries.options(joinedload('event')).
+              order_by(FeedEntry.time.desc(), FeedEntry.event_id.desc()).
+              limit(limit).all())
+    return newest, total
+
+
+def send_digests(now=None, batch=100):
+    """ Sends a digest to every user due one. Users are worked through in
+    batches by id, each batch committed once its emails are out, so a run
+    that dies part way only resends what wasn't recorded. Returns how many
+    digests were sent """
+    now = now or datetime.datetime.utcnow()
+    limit = current_app.config.get('digest_max_events', 20)
+    sent = 0
+    last_id = 0
+    while True:
+        users = (User.query.
+                 filter(User.id > last_id, due_clause(now)).
+                 options(joinedload('emails')).
+                 order_by(User.id).limit(batch).all())
+        if not users:
+            break
+        last_id = users[-1].id
+
+        emails = []
+        pending = []
+        for user in users:
+            address = user.primary_email
+            if address is None or not address.activated:
+                continue
+            entries, total = digest_entries(user, now, limit)
+            if not entries:
+                # nothing new, check again once another period is up
+                user.digest_time = now
+                continue
+            events = [entry.to_event() for entry in entries]
+            events = [event for event in events if event is not None]
+            emails.append((DigestEmail(user, events, total), address.address))
+            pending.append((user, entries[0].cursor))
+
+        for (user, cursor), ok in zip(pending, send_bulk(emails)):
+            # anything that failed goes out with the next run
+            if ok:
+                user.digest_time = now
+                user.digest_cursor = cursor
+                sent += 1
+        db.session.commit()
+    return sent
@@ -1,87 +1,339 @@
 from . import db
-from .model_lib import BaseMapper
-from .models import User
-from .util import trunc
+from .model_lib import (BaseMapper, EventRecord, FeedEntry, FanoutJob,
+                        FeedArchive, EventFeed, Subscription, EVENT_JSON,
+                        encode_event, decode_event, encode_cursor,
+                        event_type, compile_rules, touch_things)
+from .models import User, Thing
+from .util import trunc, jsonable
+from . import stream
 
-from sqlalchemy.orm import joinedload
 from flask import current_app
-from lever import jsonize
+from werkzeug.local import LocalProxy
 
+import copy
 import flask_sqlalchemy
 import datetime
+import json
+import sqlalchemy
+import six
 
 
-class Event(BaseMapper):
-    def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+def _compile_dict(name, cls_name, keys, extra=False):
+    """ Generates a method that builds a jsonized dictionary of keys, leaving
+    out any that aren't set. Saves jsonize probing every attribute with
+    getattr and sorting out what it got back for every event serialized """
+    lines = ["def {}(self):".format(name),
+             "    ret = {{'_cls': {!r}}}".format(cls_name)]
+    for key in keys:
+        lines += ["    try:",
+                  "        ret[{!r}] = jsonable(self.{})".format(key, key),
+                  "    except AttributeError:",
+                  "        pass"]
+    if extra:
+        lines += ["    if self._extra:",
+                  "        for key, val in six.iteritems(self._extra):",
+                  "            ret.setdefault(key, jsonable(val))"]
+    lines.append("    return ret")
+    namespace = {'jsonable': jsonable, 'six': six}
+    six.exec_("\n".join(lines), namespace)
+    return namespace[name]
 
-    def to_dict(self):
-        ret = jsonize(self, self.__dict__.keys(), raw=True)
-        ret["_cls"] = self.__class__.__name__
-        return ret
+
+def _compile_init(keys):
+    """ Generates an __init__ that sets the given slots from keyword
+    arguments and keeps any others in _extra """
+    lines = ["def __init__(self, {}**extra):".format(
+        "".join("{}=_unset, ".format(key) for key in keys))]
+    for key in keys:
+        lines += ["    if {} is not _unset:".format(key),
+                  "        self.{0} = {0}".format(key)]
+    lines += ["    extra.pop('_cls', None)",
+              "    self._extra = extra or None"]
+    namespace = {'_unset': object()}
+    six.exec_("\n".join(lines), namespace)
+    return namespace['__init__']
+
+
+class EventMeta(type):
+    """ Gives every Event class a slot for each of its declared fields in
+    place of an instance dictionary, and compiles its serializers """
+
+    def __new__(mcs, name, bases, dct):
+        inherited = set()
+        for base in bases:
+            inherited.update(getattr(base, '_all_slots', ()))
+        slots = tuple(dct.get('__slots__', ()))
+        dct['__slots__'] = slots + tuple(
+            f for f in dct.get('fields', ())
+            if f not in inherited and f not in slots)
+        cls = type.__new__(mcs, name, bases, dct)
+        cls._all_slots = tuple(inherited) + dct['__slots__']
+        if '__init__' not in dct:
+            cls.__init__ = _compile_init(
+                [k for k in cls._all_slots if not k.startswith('_')])
+        if 'to_dict' not in dct:
+            cls.to_dict = _compile_dict('to_dict', name, cls.fields,
+                                        extra=True)
+        if 'to_json' not in dct:
+            join = [k for k in getattr(cls, 'standard_join', [])
+                    if k != '__dont_mongo']
+            cls.to_json = _compile_dict('to_json', name, join)
+        return cls
+
+
+class Event(six.with_metaclass(EventMeta, BaseMapper)):
+    """ Base for everything that gets delivered to feeds. Subclasses declare
+    their fields, which become slots, so a decoded event costs no more than
+    its values. Anything else given when constructing one, like keys from an
+    event stored under an older schema, is kept in _extra """
+    __slots__ = ('origin', '_record', '_cursor', '_extra')
+    # the attributes stored positionally by the compact encoding. this is
+    # the storage schema and is append only, existing entries may never be
+    # reordered or removed or stored events will decode into the wrong
+    # attributes
+    fields = ()
+
+    def __getattr__(self, key):
+        # only called when the attribute isn't set normally
+        if not key.startswith('_') and self._extra and key in self._extra:
+            return self._extra[key]
+        raise AttributeError(key)
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        for slot in self._all_slots:
+            try:
+                setattr(new, slot, getattr(self, slot))
+            except AttributeError:
+                pass
+        return new
+
+    @classmethod
+    def generate(cls, obj):
+        """ Builds the event for a newly created object and sends it out """
+        notif, targets = cls.build(obj)
+        notif.distribute(*targets)
+
+    @classmethod
+    def build(cls, obj, time=None):
+        """ Returns the event for obj along with the targets it's sent to.
+        Time defaults to now, but can be given to replay old objects """
+        raise NotImplementedError
+
+    def merge(self, newer):
+        """ Folds a later event of the same group into this one. Returns
+        False if the two can't be combined """
+        return False
+
+    def coalesce(self, key, audience=None):
+        """ Merges the event into the last one stored under key, provided
+        that went out less than coalesce_window seconds ago. Returns True if
+        it was merged, in which case everywhere the earlier event was
+        delivered already shows it. Otherwise the event is stored under key
+        for later ones to merge into. Audience is the query of subscriptions
+        the events go out to, nothing is merged while any of their rules
+        would drop either event """
+        window = current_app.config.get('coalesce_window', 300)
+        if not window:
+            return False
+        last = (EventRecord.query.
+                filter_by(coalesce_key=key).
+                filter(EventRecord.time >=
+                       self.time - datetime.timedelta(seconds=window)).
+                order_by(EventRecord.time.desc(), EventRecord.id.desc()).
+                with_for_update().first())
+        if last is not None:
+            event = last.data
+            if (event is not None and
+                    not self._filtered(audience, event) and
+                    event.merge(self)):
+                # rewrites the one row, none of its feed entries change
+                last.data = event
+                return True
+        self.record.coalesce_key = key
+        return False
+
+    def _filtered(self, audience, earlier):
+        """ Whether a subscription in audience would drop this event or the
+        earlier one """
+        if audience is None:
+            return False
+        return audience.filter(~sqlalchemy.and_(
+            Subscription.rules_clause(earlier),
+            Subscription.rules_clause(self))).first() is not None
+
+    @classmethod
+    def from_dict(cls, dct):
+        """ The inverse of to_dict """
+        return cls(**dct)
+
+    def pack(self):
+        """ Returns the event as [cls, present, extras, values...]. Present is
+        a bitmask of which fields were set and values holds only those, while
+        extras is a dictionary of anything set that isn't a declared field """
+        dct = self.to_dict()
+        cls = dct.pop('_cls')
+        present = 0
+        values = []
+        for i, key in enumerate(self.fields):
+            if key in dct:
+                present |= 1 << i
+                values.append(dct.pop(key))
+        return [cls, present, dct or None] + values
+
+    @classmethod
+    def unpack(cls, packed):
+        """ The inverse of pack. Fields that weren't set when the event was
+        stored are left unset """
+        _, present, extras = packed[:3]
+        values = iter(packed[3:])
+        dct = dict((key, next(values)) for i, key in enumerate(cls.fields)
+                   if present & (1 << i))
+        dct.update(extras or {})
+        return cls.from_dict(dct)
+
+    @property
+    def record(self):
+        """ The event store row that backs this event. Created the first time
+        the event gets delivered and shared by every feed it lands in """
+        if getattr(self, '_record', None) is None:
+            self._record = EventRecord(time=self.time, data=self)
+        return self._record
+
+    @property
+    def cursor(self):
+        """ The feed position this event was read from, if any. Passed back
+        to the feed API to fetch older events """
+        return getattr(self, '_cursor', None)
 
     def originates(self, id):
         """ utility function for seeing if the event originated from an id """
         return hasattr(self, 'origin') and self.origin == id
 
-    def sendable(self, user):
-        """ returns whether or not the user is subscribed to this type of event
-        """
-        return True
+    def sendable(self, rules):
+        """ returns whether or not a subscription with the given rules should
+        get this event """
+        return compile_rules(rules)(self)
+
+    def digest_line(self):
+        """ A (text, path) pair summarizing the event in a digest email, or
+        None to leave it out """
+        return None
+
+    @staticmethod
+    def fans_out_on_read(source):
+        """ Decides whether subscribers of the source get the event pushed into
+        their own feeds, or merge it in from the sources public feed when they
+        read. Sources stay in pull mode once they cross the threshold so
+        nothing already written drops out of timelines """
+        if source.fanout_on_read:
+            return True
+        threshold = current_app.config.get('fanout_pull_threshold', 1000)
+        if threshold is None:
+            return False
+        if source.subscribers.count() > threshold:
+            current_app.logger.info(
+                "Switching {} {} to fan out on read"
+                .format(source.__class__.__name__, source.id))
+            source.fanout_on_read = True
+            return True
+        return False
+
+    def distribute(self, *args):
+        """ Queues the event for the fanout worker so the request creating it
+        doesn't wait on delivery. Takes the same (obj, attr) tuples as
+        send_event, which is called directly if fanout_async is off """
+        if current_app.config.get('fanout_async', True):
+            FanoutJob.enqueue(self, args)
+        else:
+            self.send_event(*args)
 
     def send_event(self, *args):
-        """ A method that handles event disitribution """
-        # ensure everything is flushed to the db before potentially trying to distribute events to it
+        """ A method that handles event disitribution. Accepts subscriber
+        queries, (obj, 'public_events') style tuples for delivering to an event
+        attribute and (obj, 'subscribers') tuples for delivering to everyone
+        subscribed to obj. Every recipient is resolved to an id up front and
+        delivered to with bulk inserts """
+        # the event row has to exist before entries can point at it
+        record = self.record
+        retry = record.id is not None
+        db.session.add(record)
         db.session.flush()
-        # keep a list of places that have been delivered to to prevent
-        # duplicate messages
-        delivered = []
+
+        # map each (feed, owner_id) to the origin it's delivered with. the
+        # first path to reach a feed wins, later ones would be duplicates
+        targets = {}
+        # subscriber sources in the order they were given, resolved together
+        sources = []
         for arg in args:
+            # subscribers of a popular source read the event from the sources
+            # public feed instead of getting their own copy
+            if isinstance(arg, tuple) and arg[1] == 'subscribers':
+                if self.fans_out_on_read(arg[0]):
+                    arg = (arg[0], 'public_events')
+                else:
+                    sources.append(arg[0].id)
+                    continue
+
             # if it's a bas query then it's a subscribers attribute
             if isinstance(arg, flask_sqlalchemy.BaseQuery):
-                # assume its a list of subscribers
-                for subscription in arg.options(joinedload('subscriber')):
-                    # mark this path as delivered
-                    deliv_tupl = ('events', subscription.subscriber.id)
-                    if deliv_tupl not in delivered:
-                        delivered.append(deliv_tupl)
-                        self.origin = subscription.subscribee_id
-                        new = subscription.subscriber.events + [self]
-                        subscription.subscriber.events = new
-                        #current_app.logger.debug(
-                        #    "Sending event to subscribed user {} for notif "
-                        #    "{}".format(subscription.subscriber.username,
-                        #                self.__class__.__name__))
+                rows = (arg.filter(Subscription.rules_clause(self)).
+                        with_entities(Subscription.subscriber_id,
+                                      Subscription.subscribee_id))
+                for subscriber_id, subscribee_id in rows:
+                    targets.setdefault(('events', subscriber_id),
+                                       subscribee_id)
             # otherwise it's an events attribute
             elif isinstance(arg, tuple):
                 obj, event_attr = arg
-                # mark this path as delivered
-                deliv_tupl = (event_attr, obj.id)
-                if deliv_tupl not in delivered:
-                    delivered.append(deliv_tupl)
-                    # if it's going to a users public feed, record it so it can be
-                    # removed later (hiding public things...)
-                    if isinstance(obj, User):
-                        self.origin = obj.id
-                    try:
-                        new = getattr(arg[0], arg[1]) + [self]
-                    except TypeError:
-                        raise AttributeError("Invalid object passed in for event distribution, found obj {} which has "
-                                             "not attr {}".format(arg[0], arg[1]))
-                    setattr(arg[0], arg[1], new)
-                    #current_app.logger.debug(
-                    #    "Sending event to object {} event queue for notif "
-                    #    "{}".format(arg[0].__class__.__name__,
-                    #                self.__class__.__name__))
-
+                # current_user gets passed in as a proxy
+                if isinstance(obj, LocalProxy):
+                    obj = obj._get_current_object()
+                if not isinstance(getattr(type(obj), event_attr, None),
+                                  EventFeed):
+                    raise AttributeError("Invalid object passed in for event distribution, found obj {} which has "
+                                         "not attr {}".format(arg[0], arg[1]))
+                # if it's going to a users public feed, record it so it can be
+                # removed later (hiding public things...)
+                origin = obj.id if isinstance(obj, User) else None
+                targets.setdefault((event_attr, obj.id), origin)
             else:
                 current_app.logger.warn(
                     "Unkown object type given to send_event {}".format(
                         type(arg)))
 
+        if sources:
+            # one id only query for every subscriber of every source, leaving
+            # out subscriptions whose rules drop the event
+            rank = {}
+            for i, sid in enumerate(sources):
+                rank.setdefault(sid, i)
+            rows = (db.session.query(Subscription.subscriber_id,
+                                     Subscription.subscribee_id).
+                    filter(Subscription.subscribee_id.in_(set(sources))).
+                    filter(Subscription.rules_clause(self)))
+            for subscriber_id, subscribee_id in sorted(
+                    rows, key=lambda r: rank[r[1]]):
+                targets.setdefault(('events', subscriber_id), subscribee_id)
+
+        # if this is a retry, skip everywhere the event already landed
+        delivered = set()
+        if retry:
+            delivered = set(db.session.query(FeedEntry.feed,
+                                              FeedEntry.owner_id).
+                            filter_by(event_id=record.id))
+
+        rows = [(feed, owner_id, origin)
+                for (feed, owner_id), origin in six.iteritems(targets)
+                if (feed, owner_id) not in delivered]
+        bulk_deliver(record, rows)
+        return len(rows)
+
 
 class TaskNotif(Event):
     template = "events/task.html"
+    fields = ('time', 'uname', 'uavatar', 'user_p', 'pname', 'proj_p',
+              'iname', 'task_p', 'votes')
     standard_join = [
         '__dont_mongo',
         'time',
@@ -92,31 +344,39 @@ class TaskNotif(Event):
         'pname',
         'proj_p',
         'iname',
-        'task_p'
+        'task_p',
+        'cursor'
     ]
 
     @classmethod
-    def generate(cls, task):
+    def build(cls, task, time=None):
         user = task.creator
         project = task.project
         notif = cls(
-            time=datetime.datetime.utcnow(),
+            time=time or datetime.datetime.utcnow(),
             uname=user.username,
             uavatar=user.avatar,
             user_p=user.get_dur_url,
             pname=project.name,
             proj_p=project.get_dur_url,
             iname=task.title,
-            task_p=task.get_dur_url)
+            task_p=task.get_dur_url,
+            votes=task.votes)
 
-        notif.send_event((user, 'public_events'),
-                         (project, 'public_events'),
-                         project.subscribers,
-                         user.subscribers)
+        return notif, [(user, 'public_events'),
+                       (project, 'public_events'),
+                       (project, 'subscribers'),
+                       (user, 'subscribers')]
+
+    def digest_line(self):
+        return ("{} created the task {} on {}".format(
+            self.uname, self.iname, self.pname), self.task_p)
 
 
 class NewCommentNotif(Event):
     template = "events/new_comm.html"
+    fields = ('time', 'uname', 'uavatar', 'user_p', 'tname', 'thing_p',
+              'comm_p', 'message', 'others', 'votes')
     standard_join = [
         '__dont_mongo',
         'time',
@@ -127,32 +387,81 @@ class NewCommentNotif(Event):
         'tname',
         'thing_p',
         'comm_p',
-        'message'
+        'message',
+        'other_unames',
+        'cursor'
     ]
 
     @classmethod
     def generate(cls, new_comm):
+        notif, targets = cls.build(new_comm)
+        thing_subs = (new_comm.thing, 'subscribers')
+        targets.remove(thing_subs)
+        # a burst of comments on one thing reaches its subscribers as a single
+        # entry. They get a copy of the event stored on its own so merging
+        # never rewrites what the commenters public feed and followers got
+        thread = copy.copy(notif)
+        thread._record = None
+        notif.distribute(*targets)
+        audience = Subscription.query.filter_by(
+            subscribee_id=new_comm.thing.id)
+        if not thread.coalesce('comments:{}'.format(new_comm.thing.id),
+                               audience=audience):
+            thread.distribute(thing_subs)
+
+    @classmethod
+    def build(cls, new_comm, time=None):
         user = new_comm.user
         parent = new_comm.thing
         notif = cls(
-            time=datetime.datetime.utcnow(),
+            time=time or datetime.datetime.utcnow(),
             uname=user.username,
             uavatar=user.avatar,
             user_p=user.get_dur_url,
             tname=parent.title,
             thing_p=parent.get_dur_url,
             comm_p=new_comm.get_dur_url,
-            message=trunc(new_comm.message))
-
+            message=trunc(new_comm.message),
+            votes=getattr(parent, 'votes', None))
 
         # potentially add notifications to the project
-        notif.send_event((user, 'public_events'),
-                         parent.subscribers,
-                         user.subscribers)
+        return notif, [(user, 'public_events'),
+                       (parent, 'subscribers'),
+                       (user, 'subscribers')]
+
+    @property
+    def other_unames(self):
+        """ Everyone else who commented in the burst. others is never set on
+        a comment that hasn't been merged with another, or on one stored
+        before bursts were merged """
+        return list(getattr(self, 'others', None) or [])
+
+    def merge(self, newer):
+        """ Shows the newest comment, with everyone else who commented in the
+        meantime listed in others """
+        if newer.uname != self.uname:
+            others = [self.uname] + list(getattr(self, 'others', None) or [])
+            self.others = [uname for uname in others if uname != newer.uname]
+        self.uname = newer.uname
+        self.uavatar = newer.uavatar
+        self.user_p = newer.user_p
+        self.comm_p = newer.comm_p
+        self.message = newer.message
+        self.votes = newer.votes
+        return True
+
+    def digest_line(self):
+        others = getattr(self, 'others', None) or []
+        who = self.uname
+        if others:
+            who += " and {} more".format(len(others))
+        return ("{} commented on {}".format(who, self.tname), self.comm_p)
 
 
 class NewProjNotif(Event):
     template = "events/new_proj.html"
+    fields = ('time', 'uname', 'uavatar', 'user_p', 'pname', 'proj_p',
+              'votes')
     standard_join = [
         '__dont_mongo',
         'time',
@@ -161,20 +470,348 @@ class NewProjNotif(Event):
         'uavatar',
         'user_p',
         'pname',
-        'proj_p'
+        'proj_p',
+        'cursor'
     ]
 
     @classmethod
-    def generate(cls, new_proj):
+    def build(cls, new_proj, time=None):
         user = new_proj.owner
         notif = cls(
-            time=datetime.datetime.utcnow(),
+            time=time or datetime.datetime.utcnow(),
             uname=user.username,
             uavatar=user.avatar,
             user_p=user.get_dur_url,
             pname=new_proj.name,
-            proj_p=new_proj.get_dur_url)
+            proj_p=new_proj.get_dur_url,
+            votes=new_proj.votes)
+
+        return notif, [(user, 'public_events'),
+                       (new_proj, 'public_events'),
+                       (user, 'subscribers')]
+
+    def digest_line(self):
+        return ("{} started the project {}".format(self.uname, self.pname),
+                self.proj_p)
+
+
+deliver_sql = sqlalchemy.text(
+    "INSERT INTO feed_entry (owner_id, feed, event_id, origin_id, time) "
+    "SELECT unnest(CAST(:owner_ids AS INTEGER[])), "
+    "unnest(CAST(:feeds AS VARCHAR[])), :event_id, "
+    "unnest(CAST(:origin_ids AS INTEGER[])), :time")
+
+
+# the feeds that keep an unread count and notify live streams
+UNREAD_FEEDS = ('events',)
+
+unread_sql = sqlalchemy.text(
+    "INSERT INTO feed_state (owner_id, feed, unread) "
+    "SELECT unnest(CAST(:owner_ids AS INTEGER[])), :feed, 1 "
+    "ON CONFLICT (owner_id, feed) DO UPDATE "
+    "SET unread = feed_state.unread + 1")
+
+
+def bulk_deliver(record, targets):
+    """ Delivers an event to a list of (feed, owner_id, origin) targets with a
+    single INSERT. The targets are passed as parallel arrays so the statement
+    stays the same size no matter how many recipients there are. Unread
+    counts of the recipients are bumped and their streams notified in the
+    same transaction. Public feeds are shown on their owners pages, so
+    their owners versions are bumped """
+    if not targets:
+        return
+    feeds, owner_ids, origin_ids = zip(*targets)
+    db.session.execute(deliver_sql, {'owner_ids': list(owner_ids),
+                                     'feeds': list(feeds),
+                                     'origin_ids': list(origin_ids),
+                                     'event_id': record.id,
+                                     'time': record.time})
+    touch_things(db.session(), [owner_id for feed, owner_id, _ in targets
+                                if feed == 'public_events'])
+    for feed in UNREAD_FEEDS:
+        counted = [owner_id for target_feed, owner_id, _ in targets
+                   if target_feed == feed]
+        if not counted:
+            continue
+        if current_app.config.get('feed_count_unread', True):
+            db.session.execute(unread_sql, {'owner_ids': counted,
+                                            'feed': feed})
+        stream.notify(counted, feed, encode_cursor(record.time, record.id))
+
+
+claim_sql = sqlalchemy.text(
+    "SELECT id FROM fanout_job WHERE run_at <= :now AND attempts < :attempts "
+    "ORDER BY run_at, id LIMIT 1 FOR UPDATE SKIP LOCKED")
+
+
+def drain_fanout(batch=100):
+    """ Delivers up to batch queued events and returns how many were handled.
+    Jobs are claimed with SKIP LOCKED so any number of workers can drain side
+    by side. Each is delivered inside a savepoint so a failure is recorded
+    while the claim is still held and the job can't be picked up by another
+    worker before its backoff is set """
+    max_attempts = current_app.config.get('fanout_max_attempts', 10)
+    done = 0
+    while done < batch:
+        now = datetime.datetime.utcnow()
+        row = db.session.execute(
+            claim_sql, {'now': now, 'attempts': max_attempts}).first()
+        if row is None:
+            db.session.rollback()
+            break
+        job = FanoutJob.query.filter_by(id=row[0]).one()
+        try:
+            with db.session.begin_nested():
+                event = job.event.data
+                if event is None:
+                    raise ValueError("Event {} can't be decoded"
+                                     .format(job.event_id))
+                event._record = job.event
+                args = [(Thing.query.filter_by(id=thing_id).one(), attr)
+                        for attr, thing_id in job.targets]
+                event.send_event(*args)
+                db.session.delete(job)
+        except Exception as e:
+            current_app.logger.error(
+                "Fanout of job {} failed".format(row[0]), exc_info=True)
+            # back off exponentially before trying again
+            job.attempts += 1
+            job.error = str(e)
+            job.run_at = now + datetime.timedelta(
+                seconds=min(2 ** job.attempts, 3600))
+            if job.attempts >= max_attempts:
+                current_app.logger.error(
+                    "Giving up on fanout job {} for event {} after {} "
+                    "attempts, it will stay queued until requeued by hand: {}"
+                    .format(job.id, job.event_id, job.attempts, job.error))
+        db.session.commit()
+        done += 1
+    return done
+
+
+def dead_fanout_jobs():
+    """ The queued jobs that have used up all their attempts """
+    max_attempts = current_app.config.get('fanout_max_attempts', 10)
+    return (FanoutJob.query.filter(FanoutJob.attempts >= max_attempts).
+            order_by(FanoutJob.id))
+
+
+def feed_policy(feed):
+    """ Returns the (max_entries, cutoff) that the hot window of a feed is
+    held to. Either can be disabled by configuring it as None """
+    cap = current_app.config.get('feed_max_entries', {}).get(feed, 500)
+    days = current_app.config.get('feed_retention_days', {}).get(feed, 90)
+    cutoff = None
+    if days is not None:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    return cap, cutoff
+
+
+def compact_feed(owner_id, feed, cap, cutoff, chunk=200):
+    """ Moves the oldest entries that fall outside the cap or retention of one
+    feed into archive chunks. At most ten chunks are moved per call """
+    entries = (db.session.query(FeedEntry.time, FeedEntry.event_id,
+                                FeedEntry.origin_id).
+               filter_by(owner_id=owner_id, feed=feed))
+    conds = []
+    if cap is not None:
+        boundary = (entries.order_by(FeedEntry.time.desc(),
+                                     FeedEntry.event_id.desc()).
+                    offset(cap).first())
+        if boundary is not None:
+            conds.append(
+                sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) <=
+                sqlalchemy.tuple_(boundary.time, boundary.event_id))
+    if cutoff is not None:
+        conds.append(FeedEntry.time < cutoff)
+    if not conds:
+        return 0
+
+    old = (entries.filter(sqlalchemy.or_(*conds)).
+           order_by(FeedEntry.time, FeedEntry.event_id).
+           limit(chunk * 10).all())
+    if not old:
+        return 0
+    old.reverse()
+    for i in range(0, len(old), chunk):
+        db.session.add(FeedArchive.pack(owner_id, feed, old[i:i + chunk]))
+    # delete exactly what was archived so nothing delivered in the meantime
+    # gets lost
+    (FeedEntry.query.
+     filter_by(owner_id=owner_id, feed=feed).
+     filter(FeedEntry.event_id.in_([e.event_id for e in old])).
+     delete(synchronize_session=False))
+    return len(old)
+
+
+def compact_feeds(batch=100, chunk=200):
+    """ Enforces feed caps and retention by archiving old entries. Works
+    through batch feeds per transaction so locks are only held briefly, and
+    returns how many entries were archived """
+    archived = 0
+    feeds = [f for f, in db.session.query(FeedEntry.feed).distinct().all()]
+    for feed in feeds:
+        cap, cutoff = feed_policy(feed)
+        having = []
+        if cap is not None:
+            having.append(sqlalchemy.func.count() > cap)
+        if cutoff is not None:
+            having.append(sqlalchemy.func.min(FeedEntry.time) < cutoff)
+        if not having:
+            continue
+
+        # walk the owners in id order rather than re-aggregating the whole
+        # table for every batch. each batch only groups the owners after the
+        # last one handled, which postgres reads off ix_feed_entry_time
+        last_id = 0
+        while True:
+            owners = (db.session.query(FeedEntry.owner_id).
+                      filter(FeedEntry.owner_id > last_id,
+                             FeedEntry.feed == feed).
+                      group_by(FeedEntry.owner_id).
+                      having(sqlalchemy.or_(*having)).
+                      order_by(FeedEntry.owner_id).
+                      limit(batch).all())
+            if not owners:
+                break
+            for owner_id, in owners:
+                # a feed with a big backlog takes a few passes
+                while True:
+                    done = compact_feed(owner_id, feed, cap, cutoff,
+                                        chunk=chunk)
+                    archived += done
+                    if done < chunk * 10:
+                        break
+                    db.session.commit()
+                last_id = owner_id
+            db.session.commit()
+    db.session.commit()
+    return archived
+
+
+def migrate_events(batch=1000):
+    """ Converts the event table to the compact encoding. The payload column
+    is switched to bytea and the coalesce_key and cls columns added the first
+    time this is run, then rows still holding JSON are rewritten and rows
+    without their class recorded get it filled in, batch at a time. Returns
+    how many were rewritten """
+    for column, ddl in [
+            ('coalesce_key',
+             ["ALTER TABLE event ADD COLUMN coalesce_key varchar(64)",
+              "CREATE INDEX ix_event_coalesce ON event (coalesce_key, time)"]),
+            ('cls', ["ALTER TABLE event ADD COLUMN cls varchar(64)"])]:
+        exists = db.session.execute(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'event' AND column_name = :column",
+            {'column': column}).scalar()
+        if not exists:
+            current_app.logger.info("Adding {} to events".format(column))
+            for statement in ddl:
+                db.session.execute(statement)
+            db.session.commit()
+
+    col_type = db.session.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'event' AND column_name = 'data'").scalar()
+    if col_type != 'bytea':
+        current_app.logger.info("Converting event payloads to bytea")
+        db.session.execute(
+            "ALTER TABLE event ALTER COLUMN data TYPE bytea "
+            "USING convert_to(data, 'UTF8')")
+        db.session.commit()
+
+    table = EventRecord.__table__
+    done = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            "SELECT id, data FROM event WHERE id > :last_id AND "
+            "(get_byte(data, 0) = :tag OR cls IS NULL) ORDER BY id "
+            "LIMIT :batch",
+            {'last_id': last_id,
+             'tag': ord(EVENT_JSON),
+             'batch': batch}).fetchall()
+        if not rows:
+            break
+        for id, raw in rows:
+            values = {'cls': event_type(raw)}
+            if bytes(raw)[:1] == EVENT_JSON:
+                event = decode_event(raw)
+                if event is not None:
+                    values['data'] = encode_event(event)
+                    done += 1
+            db.session.execute(table.update().
+                               where(table.c.id == id).
+                               values(**values))
+            last_id = id
+        db.session.commit()
+    return done
+
+
+def migrate_feeds(batch=500):
+    """ Copies events stored in the old per-row JSON columns on user, project
+    and task into the event store, dropping each column once it's copied.
+    Identical events delivered to several feeds are stored once. Returns how
+    many feed entries were written """
+    # the event store tables need to exist before anything can be copied
+    db.create_all()
+    done = 0
+    records = {}
+    epoch = datetime.datetime(1970, 1, 1)
+    for table, column in [('user', 'public_events'),
+                          ('user', 'events'),
+                          ('project', 'public_events'),
+                          ('task', 'public_events')]:
+        exists = db.session.execute(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = :table AND column_name = :column",
+            {'table': table, 'column': column}).scalar()
+        if not exists:
+            continue
+
+        current_app.logger.info("Copying {}.{}".format(table, column))
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                'SELECT id, {1} FROM "{0}" WHERE id > :last_id '
+                'ORDER BY id LIMIT :batch'.format(table, column),
+                {'last_id': last_id, 'batch': batch}).fetchall()
+            if not rows:
+                break
+            for owner_id, raw in rows:
+                last_id = owner_id
+                seen = set()
+                for dct in json.loads(raw or '[]'):
+                    cls = globals().get(dct.get('_cls'))
+                    if not (isinstance(cls, type) and issubclass(cls, Event)):
+                        current_app.logger.warn(
+                            "Skipping unknown event {}".format(dct))
+                        continue
+                    # origin belongs to the delivery, not the event
+                    origin = dct.pop('origin', None)
+                    key = json.dumps(dct, sort_keys=True)
+                    if key not in records:
+                        record = EventRecord(
+                            time=epoch + datetime.timedelta(
+                                milliseconds=dct.get('time') or 0),
+                            data=cls.from_dict(dct))
+                        db.session.add(record)
+                        db.session.flush()
+                        records[key] = (record.id, record.time)
+                    event_id, time = records[key]
+                    if event_id in seen:
+                        continue
+                    seen.add(event_id)
+                    db.session.add(FeedEntry(owner_id=owner_id,
+                                             feed=column,
+                                             event_id=event_id,
+                                             origin_id=origin,
+                                             time=time))
+                    done += 1
+            db.session.commit()
 
-        notif.send_event((user, 'public_events'),
-                        (new_proj, 'public_events'),
-                         user.subscribers)
+        db.session.execute(
+            'ALTER TABLE "{}" DROP COLUMN {}'.format(table, column))
+        db.session.commit()
+    return done
@@ -26,17 +26,24 @@ class EmailBase(object):
         self.plain_context = {}
         self.html_context = {}
 
-    def send(self, to_addr, force_send=None):
-        # allow us to override the application level config manually
-        if force_send is not None:
-            self.send_real = force_send
-
-        # if we shouldn't actually send, then don't
-        if self.send_real is False:
-            current_app.logger.debug(
-                "Not sending email because configuration or override")
-            return True
-
+    def connect(self):
+        """ Opens a logged in session with the mail server. Passing it to send
+        lets several emails go out over the one connection """
+        host = smtplib.SMTP(host=self.email_server,
+                            port=self.email_port,
+                            local_hostname=self.email_ehlo,
+                            timeout=self.email_timeout)
+        host.set_debuglevel(self.email_debug)
+        if self.email_tls:
+            host.starttls()
+        if self.email_ehlo:
+            host.ehlo()
+
+        host.login(self.email_username, self.email_password)
+        return host
+
+    def message(self, to_addr):
+        """ Renders the email into a message addressed to to_addr """
         send_addr = current_app.config['email_send_address']
         send_name = current_app.config['email_send_name']
 
@@ -55,29 +62,93 @@ class EmailBase(object):
         if self.html_template is not None:
             html = render_template(self.html_template, **self.html_context)
             msg.attach(MIMEText(html, 'html'))
+        return msg
 
+    def send(self, to_addr, force_send=None, host=None):
+        # allow us to override the application level config manually
+        if force_send is not None:
+            self.send_real = force_send
+
+        # if we shouldn't actually send, then don't
+        if self.send_real is False:
+            current_app.logger.debug(
+                "Not sending email because configuration or override")
+            return True
+
+        msg = self.message(to_addr)
+        send_addr = current_app.config['email_send_address']
         try:
-            host = smtplib.SMTP(host=self.email_server,
-                                port=self.email_port,
-                                local_hostname=self.email_ehlo,
-                                timeout=self.email_timeout)
-            host.set_debuglevel(self.email_debug)
-            if self.email_tls:
-                host.starttls()
-            if self.email_ehlo:
-                host.ehlo()
-
-            host.login(self.email_username, self.email_password)
-            host.sendmail(send_addr,
-                          to_addr,
-                          msg.as_string())
-            host.quit()
+            if host is None:
+                conn = self.connect()
+                conn.sendmail(send_addr,
+                              to_addr,
+                              msg.as_string())
+                conn.quit()
+            else:
+                host.sendmail(send_addr, to_addr, msg.as_string())
             return True
+        except smtplib.SMTPServerDisconnected:
+            # whoever is sharing the connection reconnects
+            if host is not None:
+                raise
+            current_app.logger.warn('Email unable to send', exc_info=True)
+            return False
         except smtplib.SMTPException:
             current_app.logger.warn('Email unable to send', exc_info=True)
             return False
 
 
+def send_bulk(emails, force_send=None):
+    """ Sends a list of (email, to_addr) pairs, reusing one connection to the
+    mail server for as long as it lasts. The connection is replaced every
+    email_batch_size messages since servers cap how many one session can
+    carry. Returns a list of whether each one was sent """
+    batch = current_app.config.get('email_batch_size', 100)
+    host = None
+    carried = 0
+    results = []
+    try:
+        for email, to_addr in emails:
+            if force_send is not None:
+                email.send_real = force_send
+            if email.send_real is False:
+                results.append(email.send(to_addr))
+                continue
+
+            if host is not None and carried >= batch:
+                host.quit()
+                host = None
+            try:
+                if host is None:
+                    host = email.connect()
+                    carried = 0
+                sent = email.send(to_addr, host=host)
+            except smtplib.SMTPServerDisconnected:
+                # dropped between messages, one fresh try
+                host = None
+                try:
+                    host = email.connect()
+                    carried = 0
+                    sent = email.send(to_addr, host=host)
+                except smtplib.SMTPException:
+                    current_app.logger.warn('Email unable to send',
+                                            exc_info=True)
+                    sent = False
+            except smtplib.SMTPException:
+                current_app.logger.warn('Unable to connect to mail server',
+                                        exc_info=True)
+                sent = False
+            carried += 1
+            results.append(sent)
+    finally:
+        if host is not None:
+            try:
+                host.quit()
+            except smtplib.SMTPException:
+                pass
+    return results
+
+
 class TestEmail(EmailBase):
     """ a email used to test our systems and template """
 
@@ -1,28 +1,240 @@
-from flask import current_app
+from flask import current_app, g, has_app_context
 from flask.ext.login import current_user
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask.ext.sqlalchemy import (_BoundDeclarativeMeta, BaseQuery,
                                   _QueryProperty)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import HSTORE
+from sqlalchemy.dialects.postgresql import HSTORE, ARRAY, array
 from sqlalchemy.types import TypeDecorator, TEXT
+from sqlalchemy.orm import joinedload, aliased, validates
 
 from . import db
 
 import sqlalchemy
 import json
 import calendar
+import copy
+import functools
+import heapq
+import itertools
+import six
+import zlib
+
+
+def acl_cache():
+    """ The role cache of the current request, None outside of an app
+    context """
+    if not has_app_context():
+        return None
+    cache = getattr(g, 'acl_cache', None)
+    if cache is None:
+        cache = g.acl_cache = {}
+    return cache
+
+
+def clear_acl_cache(*args):
+    """ Forgets every role worked out so far in this request """
+    if has_app_context():
+        g.acl_cache = None
+
+
+# anything written can change who holds what role, as can throwing away
+# unwritten changes
+for _name in ('after_flush', 'after_commit', 'after_rollback'):
+    sqlalchemy.event.listen(sqlalchemy.orm.Session, _name, clear_acl_cache)
+
+
+bump_versions_sql = sqlalchemy.text(
+    "UPDATE thing SET version = version + 1 "
+    "WHERE id = ANY(CAST(:ids AS INTEGER[])) RETURNING id, version")
+
+
+def touched_things(session):
+    """ The ids of the Things whose pages have changed in the sessions
+    current transaction """
+    return session.info.setdefault('touched_things', set())
+
+
+def touch_things(session, thing_ids):
+    """ Bumps the version of each Thing and counts it as touched by the
+    transaction. Called by the flush hook, and directly by writes that go
+    around the ORM. Instances already loaded get their new version without a
+    refresh """
+    thing_ids = set(thing_ids) - set([None])
+    if not thing_ids:
+        return
+    touched_things(session).update(thing_ids)
+    rows = session.execute(
+        bump_versions_sql, {'ids': sorted(thing_ids)}).fetchall()
+    thing = base._decl_class_registry['Thing']
+    for thing_id, version in rows:
+        obj = session.identity_map.get(
+            sqlalchemy.orm.util.identity_key(thing, thing_id))
+        if obj is not None:
+            sqlalchemy.orm.attributes.set_committed_value(
+                obj, 'version', version)
+
+
+def touch_written(session, flush_context):
+    """ Bumps the version of every Thing whose page shows something the
+    flush wrote """
+    dirty = [obj for obj in session.dirty if session.is_modified(obj)]
+    thing_ids = set()
+    for obj in itertools.chain(session.new, dirty, session.deleted):
+        page_things = getattr(obj, 'page_things', None)
+        if page_things is not None:
+            thing_ids.update(page_things())
+    touch_things(session, thing_ids)
+
+
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_flush', touch_written)
+
+
+def prime_acl(objects, join_prof, user=current_user):
+    """ Runs bulk_user_acl over everything a join of objects is going to
+    serialize with a user_acl, following relationships named in the join
+    down through their own join profiles """
+    by_cls = {}
+    for obj in objects:
+        if obj is not None and hasattr(obj, 'acl'):
+            by_cls.setdefault(type(obj), []).append(obj)
+    for cls, objs in six.iteritems(by_cls):
+        if isinstance(join_prof, six.string_types):
+            join = getattr(cls, join_prof, [])
+        else:
+            join = join_prof
+        if 'user_acl' in join:
+            cls.bulk_user_acl(objs, user=user)
+        relationships = sqlalchemy.inspect(cls).relationships
+        for conf in join:
+            if not isinstance(conf, dict) or conf['obj'] not in relationships:
+                continue
+            children = []
+            for obj in objs:
+                child = getattr(obj, conf['obj'])
+                if isinstance(child, list):
+                    children.extend(child)
+                else:
+                    children.append(child)
+            prime_acl(children, conf.get('join_prof', 'standard_join'),
+                      user=user)
+
+
+def join_versions(objects, join_prof):
+    """ (class, id, version) of every Thing a join of objects serializes,
+    following relationships named in the join like prime_acl does """
+    versions = []
+    for obj in objects:
+        if obj is None:
+            continue
+        cls = type(obj)
+        version = getattr(obj, 'version', None)
+        if version is not None:
+            versions.append((cls.__name__, obj.id, version))
+        if isinstance(join_prof, six.string_types):
+            join = getattr(cls, join_prof, [])
+        else:
+            join = join_prof
+        relationships = sqlalchemy.inspect(cls).relationships
+        for conf in join:
+            if not isinstance(conf, dict) or conf['obj'] not in relationships:
+                continue
+            child = getattr(obj, conf['obj'])
+            children = child if isinstance(child, list) else [child]
+            versions += join_versions(
+                children, conf.get('join_prof', 'standard_join'))
+    return versions
+
+
+_eager_plans = {}
+
+
+def eager_options(cls, join_prof, parent=None, seen=()):
+    """ Turns a join profile into the loader options that fetch everything
+    get_joined will walk through in a bounded number of queries.
+    Relationships to one object are joined into the query, collections get a
+    query of their own each. Profiles are followed down through the objects
+    they name, and plans for named profiles are only worked out once """
+    top = parent is None and isinstance(join_prof, six.string_types)
+    if top and (cls, join_prof) in _eager_plans:
+        return _eager_plans[(cls, join_prof)]
+
+    if isinstance(join_prof, six.string_types):
+        join = getattr(cls, join_prof, [])
+    else:
+        join = join_prof
+    relationships = sqlalchemy.inspect(cls).relationships
+    # plain keys are serialized as strings, so there's nothing further down
+    # to load for them unless the profile also joins them as an object
+    wanted = {}
+    for conf in join:
+        if isinstance(conf, dict):
+            wanted[conf['obj']] = conf.get('join_prof', 'standard_join')
+        elif isinstance(conf, six.string_types):
+            wanted.setdefault(conf, None)
+            for key in getattr(cls, 'eager_loads', {}).get(conf, ()):
+                wanted.setdefault(key, None)
+    options = []
+    for key, child_prof in sorted(wanted.items()):
+        if key not in relationships:
+            continue
+        rel = relationships[key]
+        loader = 'subqueryload' if rel.uselist else 'joinedload'
+        if parent is None:
+            option = getattr(sqlalchemy.orm, loader)(key)
+        else:
+            option = getattr(parent, loader)(key)
+        options.append(option)
+        # a profile showing up again below itself isn't followed
+        target = rel.mapper.class_
+        if child_prof is not None and (target, child_prof) not in seen:
+            options += eager_options(target, child_prof, parent=option,
+                                     seen=seen + ((cls, join_prof),))
+
+    if top:
+        _eager_plans[(cls, join_prof)] = options
+    return options
+
+
+def request_cached(func):
+    """ Memoizes a roles style method for the rest of the request, keyed on
+    the object and the id of the user it's asked about. Callers get their
+    own copy of the result since they tend to add to it """
+    code = func.__code__
+    takes_user = 'user' in code.co_varnames[:code.co_argcount]
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = acl_cache()
+        if cache is None:
+            return func(self, *args, **kwargs)
+        user = None
+        if takes_user:
+            user = kwargs.get('user', args[0] if args else current_user)
+        key = (func.__name__, id(self), getattr(user, 'id', None))
+        hit = cache.get(key)
+        # the object is kept with its result so its id can't be reused
+        if hit is None or hit[0] is not self:
+            hit = cache[key] = (self, func(self, *args, **kwargs))
+        return copy.copy(hit[1])
+    return wrapper
 
 
 class BaseMapper(object):
     """ The base model instance for all model. Provides lots of useful
     utilities in addition to access control logic and serialization helpers """
+    # lets Event objects, which aren't mapped, go without an instance dict
+    __slots__ = ()
 
     # Allows us to run query on the class directly, instead of through a
     # session
     query_class = BaseQuery
     query = None
 
+    # relationships that serializing a property of the same name reads,
+    # loaded along with the object whenever a join profile includes it
+    eager_loads = {}
+
     # Access Control Methods
     # =========================================================================
     def roles(self, user=current_user):
@@ -40,9 +252,9 @@ class BaseMapper(object):
 
     def can(self, action, user=current_user):
         """ Can the user perform the action needed on this object instance?
-        Checks for the desired key in a list of allowed action keys. """
-        keys = self.user_acl(user=user)
-        return action in keys
+        Checks for the desired key's bit in the mask of the users roles. """
+        roles = self.roles(user=user) + user.global_roles()
+        return self.acl.permits(roles, action)
 
     @classmethod
     def can_cls(cls, action, user=current_user, **parents):
@@ -50,23 +262,64 @@ class BaseMapper(object):
         Intended to be used to determine if pre-creation events can occur, such
         as create or create_other. Requires the data on parents to be passed in
         via keyword arguments to determine parent roles"""
-        return action in cls._role_mix(cls.p_roles(**parents) + user.global_roles())
+        return cls.acl.permits(cls.p_roles(**parents) + user.global_roles(),
+                               action)
 
+    @request_cached
     def user_acl(self, user=current_user):
         """ A list of access keys the user has with context to the current
         object """
         roles = self.roles(user=user) + user.global_roles()
         return self._role_mix(roles)
 
+    def acl_group(self, user=current_user):
+        """ A key shared by every object of the class that the user is
+        guaranteed to hold the same roles on, usually the parent plus whatever
+        makes the user special to the object. None means roles can't be
+        shared """
+        return None
+
+    @classmethod
+    def bulk_user_acl(cls, objects, user=current_user):
+        """ user_acl for many objects at once. Objects are grouped by their
+        acl_group and roles are only worked out for the first of each group.
+        The results are left in the request cache so serializing the objects
+        afterwards doesn't repeat the work. Returns the acl sets in the order
+        of objects """
+        cache = acl_cache()
+        user_id = getattr(user, 'id', None)
+        global_roles = user.global_roles()
+        groups = {}
+        result = []
+        for obj in objects:
+            key = obj.acl_group(user=user)
+            roles = groups.get(key) if key is not None else None
+            if roles is None:
+                roles = obj.roles(user=user)
+                if key is not None:
+                    groups[key] = roles
+            allowed = obj._role_mix(roles + global_roles)
+            if cache is not None:
+                cache[('roles', id(obj), user_id)] = (obj, roles)
+                cache[('user_acl', id(obj), user_id)] = (obj, allowed)
+            result.append(set(allowed))
+        return result
+
     @classmethod
     def _role_mix(cls, roles):
         """ A utility that takes a list of roles and returns a set of allowed
-        actions that was determined by those roles """
-        allowed = set()
-        for role in roles:
-            allowed |= cls.acl.get(role, set())
-        current_app.logger.debug((roles, allowed))
-        return allowed
+        actions that was determined by those roles. The set is a copy, free
+        for the caller to change """
+        return set(cls.acl.allowed(cls.acl.mask(roles)))
+
+    def page_things(self):
+        """ The ids of the Things whose pages show this object. Writing it
+        bumps their versions and leaves their cached pages stale """
+        return []
+
+    # the join profiles whose output is covered by the versions of the Things
+    # they reach, and so can be answered with an ETag
+    versioned_joins = ()
 
     @classmethod
     def _inherit_roles(cls, user=current_user, **kwargs):
@@ -124,6 +377,9 @@ class Report(base):
 
     reason = db.Column(db.String(255))
 
+    def page_things(self):
+        return [self.reportee_id]
+
 
 class Vote(base):
     """ associative table for voting on things """
@@ -135,18 +391,164 @@ class Vote(base):
         db.Integer, db.ForeignKey("thing.id"), primary_key=True)
     votee = db.relationship('Thing')
 
+    def page_things(self):
+        return [self.votee_id]
+
+
+class Membership(base):
+    """ The roles a user holds on a Thing because of who they are to it, like
+    owner or maintainer. Kept up to date as those change so working out a
+    users roles is a single primary key lookup """
+    thing_id = db.Column(
+        db.Integer, db.ForeignKey("thing.id"), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), primary_key=True, index=True)
+    roles = db.Column(ARRAY(db.String), nullable=False)
+
+    grant_sql = sqlalchemy.text(
+        "INSERT INTO membership (thing_id, user_id, roles) "
+        "VALUES (:thing_id, :user_id, ARRAY[CAST(:role AS VARCHAR)]) "
+        "ON CONFLICT (thing_id, user_id) DO UPDATE "
+        "SET roles = array_append(array_remove(membership.roles, :role), "
+        ":role)")
+    revoke_sql = sqlalchemy.text(
+        "UPDATE membership SET roles = array_remove(roles, :role) "
+        "WHERE thing_id = :thing_id AND user_id = :user_id")
+    prune_sql = sqlalchemy.text(
+        "DELETE FROM membership WHERE thing_id = :thing_id "
+        "AND user_id = :user_id AND roles = '{}'")
+
+    @classmethod
+    def grant(cls, thing_id, user_id, role, conn=None):
+        """ Gives the user a role on the thing. Takes a connection so it can
+        be run from inside a flush """
+        conn = conn or db.session
+        conn.execute(cls.grant_sql, {
+            'thing_id': thing_id, 'user_id': user_id, 'role': role})
+
+    @classmethod
+    def revoke(cls, thing_id, user_id, role, conn=None):
+        conn = conn or db.session
+        params = {'thing_id': thing_id, 'user_id': user_id, 'role': role}
+        conn.execute(cls.revoke_sql, params)
+        conn.execute(cls.prune_sql, params)
+
+    @classmethod
+    def lookup(cls, thing_id, user_id):
+        """ The users roles on the thing. Read as columns so a grant made
+        since the row was last loaded is never hidden behind the identity
+        map """
+        if thing_id is None or user_id is None:
+            return []
+        roles = (db.session.query(cls.roles).
+                 filter_by(thing_id=thing_id, user_id=user_id).scalar())
+        return list(roles or [])
+
+    @classmethod
+    def lookup_many(cls, thing_ids, user_id):
+        """ lookup for many things at once, as a dict by thing id """
+        found = dict((thing_id, []) for thing_id in thing_ids)
+        if user_id is None or not found:
+            return found
+        rows = (db.session.query(cls.thing_id, cls.roles).
+                filter(cls.user_id == user_id,
+                       cls.thing_id.in_(list(found))))
+        for thing_id, roles in rows:
+            found[thing_id] = list(roles)
+        return found
+
+
+# rule keys that drop events of a type or from a sender, each followed by the
+# event class or username. kept as flat keys so the GIN index on rules covers
+# them. min_votes is the only other rule
+MUTE_EVENT = 'mute_event:'
+MUTE_USER = 'mute_user:'
+
+_compiled_rules = {}
+
+
+def compile_rules(rules):
+    """ Turns a subscriptions rules into a predicate that takes an event and
+    says whether it should be delivered. Each distinct set of rules is only
+    compiled once """
+    key = frozenset((rules or {}).items())
+    pred = _compiled_rules.get(key)
+    if pred is not None:
+        return pred
+
+    muted = frozenset(k for k, _ in key
+                      if k.startswith((MUTE_EVENT, MUTE_USER)))
+    min_votes = dict(key).get('min_votes')
+    min_votes = int(min_votes) if min_votes is not None else None
+
+    def pred(event):
+        if muted and not muted.isdisjoint(Subscription.rule_keys(event)):
+            return False
+        if min_votes is not None:
+            votes = getattr(event, 'votes', None)
+            if votes is not None and votes < min_votes:
+                return False
+        return True
+
+    if len(_compiled_rules) > 1024:
+        _compiled_rules.clear()
+    _compiled_rules[key] = pred
+    return pred
+
 
 class Subscription(base):
     """ associative table for subscribing to things. Includes an HSTORE column
-    for rules on subscription """
+    for rules on subscription, which decide what gets delivered """
     rules = db.Column(HSTORE)
     subscriber_id = db.Column(
         db.Integer, db.ForeignKey("user.id"), primary_key=True)
     subscriber = db.relationship('User', foreign_keys=subscriber_id)
 
     subscribee_id = db.Column(
-        db.Integer, db.ForeignKey("thing.id"), primary_key=True)
+        db.Integer, db.ForeignKey("thing.id"), primary_key=True, index=True)
     subscribee = db.relationship('Thing')
+    __table_args__ = (
+        db.Index('ix_subscription_rules', rules, postgresql_using='gin'),
+    )
+
+    def page_things(self):
+        # pages show the viewer whether they're subscribed
+        return [self.subscribee_id]
+
+    @validates('rules')
+    def validate_rules(self, key, rules):
+        for rule, val in (rules or {}).items():
+            if rule == 'min_votes':
+                int(val)
+            elif not rule.startswith((MUTE_EVENT, MUTE_USER)):
+                raise ValueError("Unknown subscription rule {}".format(rule))
+        return rules
+
+    @property
+    def predicate(self):
+        return compile_rules(self.rules)
+
+    @staticmethod
+    def rule_keys(event):
+        """ The mute rules that would drop the event """
+        keys = [MUTE_EVENT + event.__class__.__name__]
+        uname = getattr(event, 'uname', None)
+        if uname:
+            keys.append(MUTE_USER + uname)
+        return keys
+
+    @classmethod
+    def rules_clause(cls, event):
+        """ Filters a query of subscriptions down to the ones whose rules let
+        the event through, so the rest are never delivered to """
+        clause = ~cls.rules.has_any(array(cls.rule_keys(event)))
+        votes = getattr(event, 'votes', None)
+        if votes is not None:
+            clause = sqlalchemy.and_(clause, sqlalchemy.or_(
+                ~cls.rules.has_key('min_votes'),
+                sqlalchemy.cast(cls.rules['min_votes'],
+                                sqlalchemy.Integer) <= votes))
+        return sqlalchemy.or_(cls.rules == None, clause)
 
 
 class SubscribableMixin(object):
@@ -164,29 +566,28 @@ class SubscribableMixin(object):
     def subscribed(self, val):
         self.set_subscribed(val)
 
-    def set_subscribed(self, val, user=current_user):
+    def set_subscribed(self, val, user=current_user, rules=None):
         if val:
             current_app.logger.debug(
                 "Subscribing on {} as user {}"
                 .format(self.__class__.__name__, user.username))
             sub = Subscription(subscriber=user.get(),
-                               subscribee_id=self.id)
-            # since they're subscribing, add the last ten events from the
-            # source to their events
-            i = 0
-            for event in self.public_events:
-                # only deliver 10
-                if i == 10:
-                    break
-                if event.sendable(user):
-                    user.events = user.events + [event]
-                    i += 1
+                               subscribee_id=self.id,
+                               rules=rules)
+            # popular sources get merged into timelines on read, there's
+            # nothing to copy over
+            if self.fanout_on_read:
+                sub.save(sqlalchemy.exc.IntegrityError)
+                return True
 
-            # sort the list
-            user.events = sorted(user.events, key=lambda x: x.time)
+            # since they're subscribing, copy the newest events from the
+            # source into their feed
+            db.session.flush()
+            self.backfill(user, rules)
 
-            # save the new subscription object along with the modified events in
-            # one go. events won't get added if already subscribed...
+            # save the new subscription object along with the new feed
+            # entries in one go. events won't get added if already
+            # subscribed...
             sub.save(sqlalchemy.exc.IntegrityError)
             return True
         else:
@@ -195,13 +596,64 @@ class SubscribableMixin(object):
                 subscribee_id=self.id).delete()
             # remove all events that originate from the source they're
             # unsubscribing
-            user.events = [e for e in user.events if not e.originates(self.id)]
+            FeedEntry.query.filter_by(
+                owner_id=user.id,
+                feed='events',
+                origin_id=self.id).delete(synchronize_session=False)
+            FeedArchive.remove_origin(user.id, 'events', self.id)
 
             current_app.logger.debug(
                 "Unsubscribing on {} as user {}"
                 .format(self.__class__.__name__, user.username))
             return True
 
+    def backfill(self, user, rules=None):
+        """ Copies the newest events from this source's public feed into the
+        user's feed, skipping any they've already recieved through another
+        subscription or that the subscriptions rules drop. The source feed is
+        read newest first off its time index a page at a time, so this costs
+        the size of the backfill rather than the size of either feed """
+        limit = current_app.config.get('subscribe_backfill', 10)
+        have = aliased(FeedEntry)
+        recent = (FeedEntry.query.
+                  filter_by(owner_id=self.id, feed='public_events').
+                  filter(~sqlalchemy.exists().where(sqlalchemy.and_(
+                      have.owner_id == user.id,
+                      have.feed == 'events',
+                      have.event_id == FeedEntry.event_id))).
+                  options(joinedload('event')).
+                  order_by(FeedEntry.time.desc(),
+                           FeedEntry.event_id.desc()))
+        ids = []
+        page = recent.limit(limit).all()
+        while page:
+            for entry in page:
+                event = entry.to_event()
+                if event is not None and event.sendable(rules):
+                    ids.append(entry.event_id)
+            if len(ids) >= limit:
+                break
+            page = recent.filter(
+                sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) <
+                sqlalchemy.tuple_(page[-1].time, page[-1].event_id)
+            ).limit(limit).all()
+
+        if ids:
+            # written with a single INSERT ... SELECT
+            table = FeedEntry.__table__
+            select = sqlalchemy.select([
+                sqlalchemy.literal(user.id),
+                sqlalchemy.literal('events'),
+                table.c.event_id,
+                sqlalchemy.literal(self.id),
+                table.c.time]).where(sqlalchemy.and_(
+                    table.c.owner_id == self.id,
+                    table.c.feed == 'public_events',
+                    table.c.event_id.in_(ids[:limit])))
+            db.session.execute(table.insert().from_select(
+                ['owner_id', 'feed', 'event_id', 'origin_id', 'time'],
+                select))
+
     @property
     def subscribers(self):
         return Subscription.query.filter_by(subscribee_id=self.id)
@@ -303,29 +755,567 @@ class JSONEncodedDict(TypeDecorator):
         return value
 
 
-class EventJSON(TypeDecorator):
-    """ Wraps a list of Event objects into a JSON encoded list """
+# the first byte of a stored event says how it was encoded. events stored
+# before the compact encoding are plain JSON dictionaries
+EVENT_JSON = b'{'
+EVENT_PACKED = b'\x01'
+EVENT_PACKED_ZLIB = b'\x02'
 
-    impl = TEXT
 
-    def process_bind_param(self, value, dialect):
-        if value is not None:
-            lst = []
-            for obj in value:
-                lst.append(obj.to_dict())
-            return json.dumps(lst)
-        return "[]"
+def encode_event(event, compress=None):
+    """ Serializes a single Event object into its compact positional form,
+    zlib compressed if that makes it any smaller """
+    packed = json.dumps(event.pack(), separators=(',', ':')).encode('utf8')
+    if compress is None:
+        compress = current_app.config.get('event_compress', True)
+    if compress:
+        small = zlib.compress(packed)
+        if len(small) < len(packed):
+            return EVENT_PACKED_ZLIB + small
+    return EVENT_PACKED + packed
 
-    def process_result_value(self, value, dialect):
+
+def decode_event(raw):
+    """ The inverse of encode_event, also reading the older JSON encoding.
+    Returns None for unknown event types """
+    from . import events as events
+    raw = bytes(raw)
+    tag, body = raw[:1], raw[1:]
+    if tag == EVENT_JSON:
+        dct = json.loads(raw.decode('utf8'))
+        cls = getattr(events, dct.get("_cls"), None)
+        if cls:
+            return cls.from_dict(dct)
+        return None
+
+    if tag == EVENT_PACKED_ZLIB:
+        body = zlib.decompress(body)
+    elif tag != EVENT_PACKED:
+        raise ValueError("Unknown event encoding {!r}".format(tag))
+    packed = json.loads(body.decode('utf8'))
+    cls = getattr(events, packed[0], None)
+    if cls:
+        return cls.unpack(packed)
+    return None
+
+
+def event_type(raw):
+    """ Returns the class name an event was stored as without decoding the
+    rest of it """
+    raw = bytes(raw)
+    tag, body = raw[:1], raw[1:]
+    if tag == EVENT_JSON:
+        return json.loads(raw.decode('utf8')).get("_cls")
+    if tag == EVENT_PACKED_ZLIB:
+        body = zlib.decompress(body)
+    # packed events always start with ["<cls>",
+    return body[2:body.index(b'"', 2)].decode('utf8')
+
+
+class EventRecord(base):
+    """ Append only storage of distributed events. The event payload is
+    written once and referenced by a FeedEntry for every feed it was delivered
+    to. Loading a record only fetches the encoded payload, it isn't decoded
+    until data is accessed """
+    __tablename__ = 'event'
+    id = db.Column(db.Integer, primary_key=True)
+    time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    payload = db.Column('data', db.LargeBinary, nullable=False)
+    # the class the event was stored as, so feeds can skip ones that no
+    # longer exist without decoding the payload
+    event_cls = db.Column('cls', db.String(64))
+    # set on events that later ones can be merged into, see Event.coalesce
+    coalesce_key = db.Column(db.String(64))
+    __table_args__ = (
+        db.Index('ix_event_coalesce', coalesce_key, time),
+    )
+
+    @property
+    def data(self):
+        if getattr(self, '_event', None) is None and self.payload is not None:
+            self._event = decode_event(self.payload)
+        return self._event
+
+    @property
+    def decodable(self):
+        """ False for events stored as a type that no longer exists. Those
+        are skipped when feeds are read """
         from . import events as events
-        if value is not None:
-            lst = []
-            for dct in json.loads(value):
-                cls = getattr(events, dct.get("_cls"))
-                if cls:
-                    lst.append(cls(**dct))
-            return lst
-        return []
+        if getattr(self, '_event', None) is not None:
+            return True
+        # rows from before the class was kept are read from the payload
+        name = self.event_cls or event_type(self.payload)
+        return getattr(events, name, None) is not None
+
+    @data.setter
+    def data(self, event):
+        # only encoded when the event is replaced
+        self._event = event
+        self.payload = encode_event(event)
+        self.event_cls = event.__class__.__name__
+
+
+class FeedEntryMixin(object):
+    """ Shared by hot feed entries and ones read back out of the archive """
+
+    @property
+    def cursor(self):
+        return encode_cursor(self.time, self.event_id)
+
+    def to_event(self, origin=None):
+        """ Builds the Event object for this delivery. Origin overrides the
+        stored origin for entries merged in from another feed. Returns None
+        if the event can't be decoded """
+        if self.event.data is None:
+            return None
+        event = copy.copy(self.event.data)
+        event.origin = self.origin_id if origin is None else origin
+        event._record = self.event
+        event._cursor = self.cursor
+        return event
+
+
+class FeedEntry(base, FeedEntryMixin):
+    """ A single delivery of an event into a Things feed. Feeds are append
+    only, so inserting an event costs one row per recipient """
+    owner_id = db.Column(
+        db.Integer, db.ForeignKey("thing.id"), primary_key=True)
+    feed = db.Column(db.String(32), primary_key=True)
+    event_id = db.Column(
+        db.Integer, db.ForeignKey("event.id"), primary_key=True, index=True)
+    event = db.relationship('EventRecord')
+    # the Thing whose subscription caused the delivery, if any
+    origin_id = db.Column(db.Integer)
+    # copied from the event so feeds can be ordered without a join
+    time = db.Column(db.DateTime, nullable=False)
+
+    def page_things(self):
+        # public feeds are shown on their owners page
+        return [self.owner_id] if self.feed == 'public_events' else []
+
+    __table_args__ = (
+        db.Index('ix_feed_entry_time', owner_id, feed, time, event_id),
+        # lets unsubscribing delete exactly the entries a source delivered
+        db.Index('ix_feed_entry_origin', owner_id, feed, origin_id),
+    )
+
+
+class ArchivedEntry(FeedEntryMixin):
+    """ A feed entry unpacked from a FeedArchive chunk """
+
+    def __init__(self, event, time, origin_id):
+        self.event = event
+        self.event_id = event.id
+        self.time = time
+        self.origin_id = origin_id
+
+
+class FeedState(base):
+    """ How far the owner of a feed has read, and how many entries have been
+    delivered to it since. Fan-out bumps the counter for all its recipients
+    in one statement, so the unread count is always a single row lookup """
+    owner_id = db.Column(
+        db.Integer, db.ForeignKey("thing.id"), primary_key=True)
+    feed = db.Column(db.String(32), primary_key=True)
+    unread = db.Column(db.Integer, nullable=False, default=0)
+    seen_time = db.Column(db.DateTime)
+    seen_event_id = db.Column(db.Integer)
+
+    @property
+    def seen(self):
+        """ The cursor of the newest entry that's been read """
+        if self.seen_time is None:
+            return None
+        return encode_cursor(self.seen_time, self.seen_event_id)
+
+
+class FeedArchive(base):
+    """ A compressed chunk of feed entries that have been compacted out of the
+    hot feed_entry table. Only read by pages that reach back past the newest
+    archived entry """
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(
+        db.Integer, db.ForeignKey("thing.id"), nullable=False)
+    feed = db.Column(db.String(32), nullable=False)
+    # the range of (time, event_id) keys held in the chunk
+    newest_time = db.Column(db.DateTime, nullable=False)
+    newest_event_id = db.Column(db.Integer, nullable=False)
+    oldest_time = db.Column(db.DateTime, nullable=False)
+    oldest_event_id = db.Column(db.Integer, nullable=False)
+    # zlib compressed JSON list of [micro, event_id, origin_id], newest first
+    data = db.Column(db.LargeBinary, nullable=False)
+    # every origin in the chunk so unsubscribing can find what to rewrite
+    origins = db.Column(ARRAY(db.Integer), nullable=False, default=list)
+
+    __table_args__ = (
+        db.Index('ix_feed_archive_newest', owner_id, feed, newest_time,
+                 newest_event_id),
+        db.Index('ix_feed_archive_origins', origins, postgresql_using='gin'),
+    )
+
+    @classmethod
+    def pack(cls, owner_id, feed, entries):
+        """ Builds a chunk from a newest first list of FeedEntries """
+        chunk = cls(owner_id=owner_id, feed=feed)
+        chunk.set_rows([[_micro(e.time), e.event_id, e.origin_id]
+                        for e in entries])
+        return chunk
+
+    def set_rows(self, rows):
+        """ Replaces the chunks contents with a newest first list of
+        [micro, event_id, origin_id] rows """
+        self.newest_time = _from_micro(rows[0][0])
+        self.newest_event_id = rows[0][1]
+        self.oldest_time = _from_micro(rows[-1][0])
+        self.oldest_event_id = rows[-1][1]
+        self.origins = sorted(set(r[2] for r in rows if r[2] is not None))
+        self.data = zlib.compress(json.dumps(rows).encode('utf8'))
+
+    def unpack(self):
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf8'))
+
+    @classmethod
+    def remove_origin(cls, owner_id, feed, origin_id):
+        """ Drops every archived entry delivered because of origin_id,
+        rewriting only the chunks that hold one """
+        chunks = (cls.query.filter_by(owner_id=owner_id, feed=feed).
+                  filter(cls.origins.contains([origin_id])))
+        for chunk in chunks:
+            rows = [r for r in chunk.unpack() if r[2] != origin_id]
+            if rows:
+                chunk.set_rows(rows)
+            else:
+                db.session.delete(chunk)
+
+    @classmethod
+    def newest(cls, sources, before=None):
+        """ Returns {(owner_id, feed): newest_time} of the archived entries
+        for (owner_id, feed) pairs, leaving out any without an archive """
+        owners = set(owner_id for owner_id, _ in sources)
+        query = (db.session.query(cls.owner_id, cls.feed,
+                                  sqlalchemy.func.max(cls.newest_time)).
+                 filter(cls.owner_id.in_(owners)))
+        if before is not None:
+            time, event_id = decode_cursor(before)
+            query = query.filter(
+                sqlalchemy.tuple_(cls.oldest_time, cls.oldest_event_id) <
+                sqlalchemy.tuple_(time, event_id))
+        query = query.group_by(cls.owner_id, cls.feed)
+        return dict(((owner_id, feed), newest)
+                    for owner_id, feed, newest in query.all()
+                    if (owner_id, feed) in sources)
+
+    @classmethod
+    def entries(cls, owner_id, feed, before=None, limit=None):
+        """ Returns ArchivedEntries for the feed, newest first. Chunks are
+        decompressed newest first until no remaining chunk could hold
+        anything newer than what's already been found """
+        chunks = (db.session.query(cls.id, cls.newest_time,
+                                   cls.newest_event_id).
+                  filter_by(owner_id=owner_id, feed=feed))
+        bound = None
+        if before is not None:
+            time, event_id = decode_cursor(before)
+            bound = (_micro(time), event_id)
+            chunks = chunks.filter(
+                sqlalchemy.tuple_(cls.oldest_time, cls.oldest_event_id) <
+                sqlalchemy.tuple_(time, event_id))
+        chunks = chunks.order_by(cls.newest_time.desc(),
+                                 cls.newest_event_id.desc())
+
+        rows = []
+        for chunk_id, newest_time, newest_event_id in chunks.all():
+            if limit is not None and len(rows) >= limit:
+                rows.sort(reverse=True)
+                del rows[limit:]
+                if (_micro(newest_time), newest_event_id) < tuple(rows[-1][:2]):
+                    break
+            for row in cls.query.get(chunk_id).unpack():
+                if bound is None or tuple(row[:2]) < bound:
+                    rows.append(row)
+        rows.sort(reverse=True)
+        if limit is not None:
+            del rows[limit:]
+
+        records = {}
+        if rows:
+            ids = [event_id for _, event_id, _ in rows]
+            records = dict((r.id, r) for r in
+                           EventRecord.query.filter(EventRecord.id.in_(ids)))
+        return [ArchivedEntry(records[event_id], _from_micro(micro), origin_id)
+                for micro, event_id, origin_id in rows
+                if event_id in records]
+
+
+class FanoutJob(base):
+    """ A queued event distribution. Written in the same transaction as the
+    thing that caused the event and drained by the fanout worker """
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(
+        db.Integer, db.ForeignKey("event.id"), nullable=False)
+    event = db.relationship('EventRecord')
+    # a list of [attr, thing_id] pairs as passed to send_event
+    targets = db.Column(JSONEncodedDict, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    run_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False,
+                       index=True)
+    error = db.Column(db.String)
+
+    @classmethod
+    def enqueue(cls, event, args):
+        targets = []
+        for arg in args:
+            if not isinstance(arg, tuple):
+                raise TypeError(
+                    "Only (obj, attr) targets can be queued, got {}"
+                    .format(type(arg)))
+            targets.append([arg[1], arg[0].id])
+        job = cls(event=event.record, targets=targets)
+        db.session.add(job)
+        return job
+
+
+def _micro(time):
+    return calendar.timegm(time.utctimetuple()) * 1000000 + time.microsecond
+
+
+def _from_micro(micro):
+    return datetime(1970, 1, 1) + timedelta(microseconds=micro)
+
+
+def encode_cursor(time, event_id):
+    """ Packs a feed position into an opaque string for the client. Times are
+    kept to the microsecond so cursors never skip entries """
+    return "{}_{}".format(_micro(time), event_id)
+
+
+def decode_cursor(cursor):
+    """ The inverse of encode_cursor. Raises ValueError on garbage """
+    micro, event_id = cursor.split('_')
+    micro, event_id = int(micro), int(event_id)
+    # event ids are a postgres integer
+    if not 0 <= event_id < 2 ** 31:
+        raise ValueError("Cursor event id out of range")
+    try:
+        time = _from_micro(micro)
+    except OverflowError:
+        raise ValueError("Cursor time out of range")
+    return time, event_id
+
+
+def merge_feeds(streams, limit=None):
+    """ Heap merges several newest first streams of feed entries into one,
+    dropping events that show up in more than one stream. Streams are
+    (origin, entries) pairs and the result is (origin, entry) pairs """
+    def keyed(i, origin, entries):
+        for entry in entries:
+            yield (-_micro(entry.time), -entry.event_id), i, origin, entry
+
+    ret = []
+    seen = set()
+    merged = heapq.merge(*[keyed(i, origin, entries)
+                           for i, (origin, entries) in enumerate(streams)])
+    for _, _, origin, entry in merged:
+        if limit is not None and len(ret) == limit:
+            break
+        if entry.event_id not in seen:
+            seen.add(entry.event_id)
+            ret.append((origin, entry))
+    return ret
+
+
+class EventFeed(object):
+    """ A read view over one of a Things feeds in the event store. Reading
+    gives a time ordered list of Event objects while assigning a list replaces
+    the feeds contents """
+
+    def __init__(self, feed):
+        self.feed = feed
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return obj.get_feed(self.feed)
+
+    def __set__(self, obj, value):
+        obj.clear_feed(self.feed)
+        for event in value or []:
+            obj.add_event(self.feed, event)
+
+
+class LazyFeed(object):
+    """ The events of a feed, oldest first. Holds the feed entries as loaded
+    and only builds Event objects for the ones that are indexed, sliced or
+    iterated over. Appending delivers the event without touching the rest """
+
+    def __init__(self, owner, feed, entries):
+        self.owner = owner
+        self.feed = feed
+        self._entries = [(origin, entry) for origin, entry in entries
+                         if entry.event.decodable]
+        self._events = [None] * len(self._entries)
+
+    def _event(self, i):
+        if self._events[i] is None:
+            origin, entry = self._entries[i]
+            self._events[i] = entry.to_event(origin)
+        return self._events[i]
+
+    def __len__(self):
+        return len(self._events)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._event(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("feed index out of range")
+        return self._event(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._event(i)
+
+    def append(self, event, origin=None):
+        entry = self.owner.add_event(self.feed, event, origin=origin)
+        self._entries.append((origin, entry))
+        self._events.append(None)
+
+
+class FeedMixin(object):
+    """ Storage helpers for Things that own EventFeeds """
+
+    def feed_sources(self, feed):
+        """ The (owner_id, feed, origin) triples whose entries make up one of
+        our feeds. Overridden by feeds that merge in other feeds on read """
+        return [(self.id, feed, None)]
+
+    def feed_entries(self, feed, before=None, limit=None):
+        """ Returns (origin, entry) pairs for the feed, newest first """
+        # make sure pending deliveries show up
+        db.session.flush()
+        sources = self.feed_sources(feed)
+        # the archive only needs reading for feeds where the page reaches
+        # back as far as the newest archived entry. entries backfilled into
+        # the hot table can be older than archived ones, so this is checked
+        # rather than assuming the archive starts where the hot entries end
+        archived = {}
+        if limit is not None:
+            archived = FeedArchive.newest(
+                set((owner_id, src_feed)
+                    for owner_id, src_feed, _ in sources), before=before)
+
+        streams = []
+        for owner_id, src_feed, origin in sources:
+            entries = (FeedEntry.query.
+                       filter_by(owner_id=owner_id, feed=src_feed).
+                       options(joinedload('event')))
+            if before is not None:
+                time, event_id = decode_cursor(before)
+                entries = entries.filter(
+                    sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) <
+                    sqlalchemy.tuple_(time, event_id))
+            entries = entries.order_by(FeedEntry.time.desc(),
+                                       FeedEntry.event_id.desc())
+            if limit is not None:
+                entries = entries.limit(limit).all()
+            streams.append((origin, entries))
+
+            newest = archived.get((owner_id, src_feed))
+            if newest is not None and (len(entries) < limit or
+                                       newest >= entries[-1].time):
+                streams.append((origin, FeedArchive.entries(
+                    owner_id, src_feed, before=before, limit=limit)))
+
+        if len(streams) == 1:
+            origin, entries = streams[0]
+            return [(origin, entry) for entry in entries]
+        return merge_feeds(streams, limit=limit)
+
+    def get_feed(self, feed):
+        """ Returns all events in the feeds hot window, oldest first """
+        entries = self.feed_entries(feed)
+        entries.reverse()
+        return LazyFeed(self, feed, entries)
+
+    def feed_page(self, feed, before=None, limit=None):
+        """ Returns a page of events from the feed, newest first. Before is a
+        cursor from a previous page and only older entries will be returned """
+        if limit is None:
+            limit = current_app.config.get('feed_page_size', 20)
+        entries = self.feed_entries(feed, before=before, limit=limit)
+        events = [entry.to_event(origin) for origin, entry in entries]
+        return [event for event in events if event is not None]
+
+    @property
+    def recent_public_events(self):
+        """ The newest page of our public feed in the order it happened. Used
+        by join profiles so they don't embed the entire history """
+        return list(reversed(self.feed_page('public_events')))
+
+    def add_event(self, feed, event, origin=None):
+        """ Delivers an event to one of our feeds. The event itself is only
+        stored the first time it's delivered anywhere """
+        if not isinstance(getattr(self.__class__, feed, None), EventFeed):
+            raise AttributeError(
+                "{} has no event feed {}".format(self.__class__.__name__,
+                                                 feed))
+        record = event.record
+        entry = FeedEntry(owner_id=self.id,
+                          feed=feed,
+                          event=record,
+                          origin_id=origin,
+                          time=record.time)
+        db.session.add(entry)
+        return entry
+
+    def clear_feed(self, feed):
+        """ Removes every entry from one of our feeds """
+        db.session.flush()
+        FeedEntry.query.filter_by(
+            owner_id=self.id, feed=feed).delete(synchronize_session=False)
+        FeedArchive.query.filter_by(
+            owner_id=self.id, feed=feed).delete(synchronize_session=False)
+        FeedState.query.filter_by(
+            owner_id=self.id, feed=feed).delete(synchronize_session=False)
+
+    def feed_state(self, feed):
+        """ Our read position and unread count for a feed. Nothing's unread
+        in a feed that's never had anything counted """
+        # fan-out updates the counter behind the sessions back
+        state = (FeedState.query.filter_by(owner_id=self.id, feed=feed).
+                 populate_existing().first())
+        return state or FeedState(owner_id=self.id, feed=feed, unread=0)
+
+    def mark_seen(self, feed, before=None):
+        """ Records that the feed has been read up to the cursor before, or
+        all the way if it isn't given, and resets the unread count to match.
+        The state row is locked first so a delivery that lands meanwhile is
+        either counted after this or seen by it, never lost """
+        db.session.flush()
+        db.session.execute(
+            "INSERT INTO feed_state (owner_id, feed, unread) "
+            "VALUES (:owner_id, :feed, 0) ON CONFLICT DO NOTHING",
+            {'owner_id': self.id, 'feed': feed})
+        state = (FeedState.query.filter_by(owner_id=self.id, feed=feed).
+                 with_for_update().populate_existing().one())
+        entries = (FeedEntry.query.filter_by(owner_id=self.id, feed=feed).
+                   order_by(FeedEntry.time.desc(), FeedEntry.event_id.desc()))
+        if before is None:
+            newest = entries.first()
+            if newest is not None:
+                state.seen_time = newest.time
+                state.seen_event_id = newest.event_id
+            state.unread = 0
+        else:
+            time, event_id = decode_cursor(before)
+            state.seen_time = time
+            state.seen_event_id = event_id
+            state.unread = entries.filter(
+                sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) >
+                sqlalchemy.tuple_(time, event_id)).count()
+        return state
 
 
 class PrivateMixin(object):
@@ -8,14 +8,17 @@ except ImportError:
     from urllib.parse import urljoin, urlencode
 
 from . import db, crypt, github
-from .model_lib import (base, SubscribableMixin, VotableMixin, EventJSON,
-                        ReportableMixin, JSONEncodedDict)
+from .model_lib import (base, SubscribableMixin, VotableMixin, EventFeed,
+                        FeedMixin, ReportableMixin, JSONEncodedDict,
+                        Subscription, Membership, request_cached,
+                        acl_cache)
 from .util import inherit_lst
 from .acl import acl
 from .oauth import (oauth_retrieve, providers, oauth_profile_populate,
                     oauth_from_session)
 from .mail import RecoverEmail, ActivationEmail
-from lever import get_joined, LeverSyntaxError
+from .serialize import get_joined
+from lever import LeverSyntaxError
 
 import re
 import werkzeug
@@ -29,6 +32,12 @@ import six
 class Thing(base):
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String)
+    # set once the Thing has too many subscribers to push events to each of
+    # them. subscribers then merge in its public feed when reading
+    fanout_on_read = db.Column(db.Boolean, default=False)
+    # bumped whenever the Thing or anything shown on its page is written
+    version = db.Column(db.Integer, default=0, server_default='0',
+                        nullable=False)
     __mapper_args__ = {
         'polymorphic_identity': 'Thing',
         'polymorphic_on': type
@@ -39,12 +48,18 @@ class Thing(base):
         return (self.pledges.count() /
                 self.pledges.filter(disputed=True).count())
 
+    def page_things(self):
+        return [self.id]
+
 class ProjectMaintainer(base):
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'), primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     acl = db.Column(db.Integer)
     user = db.relationship("User")
 
+    def page_things(self):
+        return [self.project_id]
+
         # Join profiles
     # ======================================================================
     standard_join = ['user_id'
@@ -63,7 +78,8 @@ class ProjectMaintainer(base):
         db.session.flush()
 
 
-class Project(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
+class Project(Thing, SubscribableMixin, VotableMixin, ReportableMixin,
+              FeedMixin):
     """ This class is a composite of thing and project tables """
     id = db.Column(db.Integer, db.ForeignKey('thing.id'), primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -81,7 +97,7 @@ class Project(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
     votes = db.Column(db.Integer, default=0)
 
     # Event log
-    public_events = db.Column(EventJSON, default=list)
+    public_events = EventFeed('public_events')
 
     # project maintainers
     maintainers_objs = db.relationship("ProjectMaintainer", backref="maintainer_powers")
@@ -130,22 +146,41 @@ class Project(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
                              'desc',
                              {'obj': 'maintainers', 'join_prof': 'disp_join'},
                              {'obj': 'owner'},
-                             {'obj': 'public_events'},
+                             {'obj': 'recent_public_events'},
                              {'obj': 'tasks', 'join_prof': 'disp_join'},
                              ]
                             )
 
     # Import the acl from acl file
     acl = acl['project']
+    versioned_joins = ('standard_join', 'page_join', 'disp_join',
+                       'task_page_join')
 
+    @request_cached
     def roles(self, user=current_user):
-        if self.owner == user:
-            return ['owner']
-        # else:
-        #     for maintainer in self.maintainers:
-        #         if maintainer == user:
-        #             return ['maintainer']
-        return []
+        return Membership.lookup(self.id, getattr(user, 'id', None))
+
+    def acl_group(self, user=current_user):
+        return ('project', self.id)
+
+    def page_things(self):
+        # the owners page lists their projects
+        return [self.id, self.owner.id if self.owner else None]
+
+    @classmethod
+    def bulk_user_acl(cls, objects, user=current_user):
+        # every project is its own group, so fetch all of their memberships
+        # in one go and let roles find them in the request cache
+        objects = list(objects)
+        cache = acl_cache()
+        if cache is not None:
+            user_id = getattr(user, 'id', None)
+            found = Membership.lookup_many(
+                [obj.id for obj in objects if obj.id is not None], user_id)
+            for obj in objects:
+                if obj.id is not None:
+                    cache[('roles', id(obj), user_id)] = (obj, found[obj.id])
+        return super(Project, cls).bulk_user_acl(objects, user=user)
 
     @property
     def get_dur_url(self):
@@ -227,7 +262,46 @@ class Project(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
         current_app.logger.debug("Desynchronized repository")
 
 
-class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
+def _owner_id(conn, username):
+    if username is None:
+        return None
+    return conn.execute(sqlalchemy.select([User.id]).
+                        where(User.username == username)).scalar()
+
+
+@sqlalchemy.event.listens_for(Project, 'after_insert')
+def _grant_owner(mapper, conn, project):
+    owner_id = _owner_id(conn, project.owner_username)
+    if owner_id is not None:
+        Membership.grant(project.id, owner_id, 'owner', conn=conn)
+
+
+@sqlalchemy.event.listens_for(Project, 'after_update')
+def _move_owner(mapper, conn, project):
+    history = sqlalchemy.inspect(project).attrs.owner_username.history
+    if not history.has_changes():
+        return
+    for username in history.deleted:
+        owner_id = _owner_id(conn, username)
+        if owner_id is not None:
+            Membership.revoke(project.id, owner_id, 'owner', conn=conn)
+    _grant_owner(mapper, conn, project)
+
+
+@sqlalchemy.event.listens_for(ProjectMaintainer, 'after_insert')
+def _grant_maintainer(mapper, conn, maintainer):
+    Membership.grant(maintainer.project_id, maintainer.user_id, 'maintainer',
+                     conn=conn)
+
+
+@sqlalchemy.event.listens_for(ProjectMaintainer, 'after_delete')
+def _revoke_maintainer(mapper, conn, maintainer):
+    Membership.revoke(maintainer.project_id, maintainer.user_id,
+                      'maintainer', conn=conn)
+
+
+class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin,
+           FeedMixin):
     id = db.Column(db.Integer, db.ForeignKey('thing.id'), primary_key=True)
     status = db.Column(db.Enum('Completed', 'Discussion', 'Selected', 'Other',
                                name="task_status"), default='Discussion')
@@ -241,7 +315,7 @@ class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
     votes = db.Column(db.Integer, default=0)
 
     # Event log
-    public_events = db.Column(EventJSON, default=list)
+    public_events = EventFeed('public_events')
 
     # our project relationship and keys
     url_key = db.Column(db.String, unique=True)
@@ -274,6 +348,7 @@ class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
     __mapper_args__ = {'polymorphic_identity': 'Task'}
 
     acl = acl['task']
+    versioned_joins = ('standard_join', 'page_join', 'disp_join', 'brief_join')
     standard_join = ['get_abs_url',
                      'title',
                      'vote_status',
@@ -292,6 +367,9 @@ class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
                              {'obj': 'creator', 'join_prof': 'disp_join'}]
                             )
 
+    # roles are inherited from the project
+    eager_loads = {'user_acl': ['project']}
+
     # used for displaying the project in noifications, etc
     brief_join = ['__dont_mongo',
                   'title',
@@ -302,12 +380,26 @@ class Task(Thing, SubscribableMixin, VotableMixin, ReportableMixin):
                  {'obj': 'project',
                   'join_prof': 'disp_join'}]
 
+    @request_cached
     def roles(self, user=current_user):
         roles = Task.p_roles(project=self.project, user=user)
-        if self.creator == user:
+        # by id so the creator doesn't have to be loaded, unless it hasn't
+        # been flushed yet
+        creator_id = self.creator_id
+        if creator_id is None and self.creator is not None:
+            creator_id = self.creator.id
+        if creator_id is not None and creator_id == getattr(user, 'id', None):
             roles.append('creator')
         return roles
 
+    def acl_group(self, user=current_user):
+        return (self.project_owner_username, self.project_url_key,
+                self.creator_id == getattr(user, 'id', None))
+
+    def page_things(self):
+        # the project page lists its tasks
+        return [self.id, self.project.id if self.project else None]
+
     @classmethod
     def p_roles(cls, project=None, user=current_user, **params):
         return cls._inherit_roles(project=project, user=user)
@@ -385,12 +477,20 @@ class Comment(base):
     def p_roles(cls, thing=None, user=current_user, **params):
         return cls._inherit_roles(thing=thing, user=user)
 
+    @request_cached
     def roles(self, user=current_user):
-        roles = Comment.p_roles(thing=self.thing)
+        roles = Comment.p_roles(thing=self.thing, user=user)
         if user == self.user:
             roles += ['creator']
         return roles
 
+    def acl_group(self, user=current_user):
+        return (self.thing_id, self.user_id == getattr(user, 'id', None))
+
+    def page_things(self):
+        # comments show up on their Thing and in their authors public events
+        return [self.thing_id, self.user_id]
+
     standard_join = [{'obj': 'user', 'join_prof': 'disp_join'},
                      'message',
                      'created_at']
@@ -421,6 +521,10 @@ class Email(base):
     activate_hash = db.Column(db.String)
     activate_gen = db.Column(db.DateTime)
 
+    def page_things(self):
+        # avatars are hashed from the primary email
+        return [self.user_id]
+
     @classmethod
     def activate_email(self, email, activate_hash="", force=False):
         current_app.logger.debug(
@@ -471,7 +575,13 @@ class Email(base):
         return ActivationEmail(self).send(self.address, force_send=force_send)
 
 
-class User(Thing, SubscribableMixin, ReportableMixin):
+# how often each digest setting emails a user, never turns them off
+DIGEST_PERIODS = {'daily': timedelta(days=1),
+                  'weekly': timedelta(days=7),
+                  'never': None}
+
+
+class User(Thing, SubscribableMixin, ReportableMixin, FeedMixin):
     id = db.Column(db.Integer, db.ForeignKey('thing.id'), primary_key=True)
     username = db.Column(db.String(32), unique=True)
     admin = db.Column(db.Boolean, default=False)
@@ -488,11 +598,17 @@ class User(Thing, SubscribableMixin, ReportableMixin):
     recover_gen = db.Column(db.DateTime)
 
     # Event information
-    public_events = db.Column(EventJSON, default=list)
-    events = db.Column(EventJSON, default=list)
+    public_events = EventFeed('public_events')
+    events = EventFeed('events')
     profile = db.Column(JSONEncodedDict, default=dict)
     __mapper_args__ = {'polymorphic_identity': 'User'}
 
+    # how often a digest of their feed gets emailed, and where the last one
+    # left off
+    _digest = db.Column('digest', db.String(8), default='daily')
+    digest_time = db.Column(db.DateTime)
+    digest_cursor = db.Column(db.String)
+
     # financial placeholders
 
     # total unpaid
@@ -510,6 +626,9 @@ class User(Thing, SubscribableMixin, ReportableMixin):
                      'profile',
                      'avatar',
                      '-_password',
+                     '-_digest',
+                     '-digest_time',
+                     '-digest_cursor',
                      '-go_token',
                      '-gh_token',
                      '-tw_token',
@@ -517,11 +636,12 @@ class User(Thing, SubscribableMixin, ReportableMixin):
                      '-events',
                      ]
     home_join = inherit_lst(standard_join,
-                            [{'obj': 'events'},
+                            ['unread_events',
+                             {'obj': 'recent_events'},
                              {'obj': 'projects', 'join_prof': 'disp_join'}])
 
     page_join = inherit_lst(standard_join,
-                            [{'obj': 'public_events'},
+                            [{'obj': 'recent_public_events'},
                              {'obj': 'projects', 'join_prof': 'disp_join'},
                               'gh_linked',
                               'go_linked',
@@ -530,6 +650,7 @@ class User(Thing, SubscribableMixin, ReportableMixin):
 
     settings_join = inherit_lst(standard_join,
                                 [{'obj': 'primary_email'},
+                                 'digest',
                                  'gh_linked',
                                  'go_linked',
                                  'tw_linked',
@@ -541,7 +662,11 @@ class User(Thing, SubscribableMixin, ReportableMixin):
                  'get_abs_url',
                  'avatar']
 
+    # the avatar is hashed from the primary email
+    eager_loads = {'avatar': ['emails']}
+
     acl = acl['user']
+    versioned_joins = ('standard_join', 'page_join', 'disp_join')
 
 
     # Financial functions
@@ -597,10 +722,41 @@ class User(Thing, SubscribableMixin, ReportableMixin):
         else:
             raise AttributeError
 
+    @property
+    def digest(self):
+        return self._digest or 'daily'
+
+    @digest.setter
+    def digest(self, val):
+        if val not in DIGEST_PERIODS:
+            raise LeverSyntaxError("Digests can be sent {}".format(
+                ", ".join(sorted(DIGEST_PERIODS))))
+        self._digest = val
+
     @property
     def get_dur_url(self):
         return "/u/{id}".format(id=self.id)
 
+    def feed_sources(self, feed):
+        sources = super(User, self).feed_sources(feed)
+        if feed == 'events':
+            # merge in the public feeds of subscriptions that fan out on read
+            pulled = (db.session.query(Subscription.subscribee_id).
+                      filter_by(subscriber_id=self.id).
+                      join(Thing, Thing.id == Subscription.subscribee_id).
+                      filter(Thing.fanout_on_read == True))
+            sources += [(sid, 'public_events', sid) for sid, in pulled]
+        return sources
+
+    @property
+    def unread_events(self):
+        return self.feed_state('events').unread
+
+    @property
+    def recent_events(self):
+        """ The newest page of the users private feed """
+        return list(reversed(self.feed_page('events')))
+
     def get_abs_url(self):
         return "/{username}".format(
             username=six.u(self.username).encode('utf-8'))
@@ -834,11 +990,16 @@ class User(Thing, SubscribableMixin, ReportableMixin):
     def get_id(self):
         return six.u(str(self.id))
 
+    @request_cached
     def roles(self, user=current_user):
         if self.id == getattr(user, 'id', None):
             return ['owner']
         return []
 
+    def acl_group(self, user=current_user):
+        return ('owner', self.id == getattr(user, 'id', None))
+
+    @request_cached
     def global_roles(self):
         """ Determines global roles for the user. """
         if self.admin:
@@ -35,3 +35,10 @@ def json_dict(self):
     return js
 Request.dict_args = dict_args
 Request.json_dict = json_dict
+
+# Monkey patch levers serializer with the compiled ones, so API responses
+# don't reflect over join profiles on every request
+# =========================================================================
+import lever.base
+from .serialize import get_joined
+lever.base.get_joined = get_joined
@@ -0,0 +1,219 @@
+""" Regenerates every feed by replaying the creation of projects, tasks and
+comments through the event generators. Used when event templates change or a
+feed has been corrupted. Progress is checkpointed to a file after each chunk
+so an interrupted rebuild picks up where it stopped. """
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from . import db
+from .models import Thing, Project, Task, Comment
+from .model_lib import (EventRecord, FeedEntry, FeedArchive, FeedState,
+                        FanoutJob, Subscription)
+from .events import NewProjNotif, TaskNotif, NewCommentNotif
+
+import datetime
+import json
+import multiprocessing
+import os
+import time
+
+
+# the models whose creation produced events, and the event they produced
+SOURCES = [(Project, NewProjNotif),
+           (Task, TaskNotif),
+           (Comment, NewCommentNotif)]
+
+
+def history():
+    """ Every (created_at, source, id) that gets replayed, oldest first """
+    rows = []
+    for i, (model, _) in enumerate(SOURCES):
+        for id, created_at in db.session.query(model.id, model.created_at):
+            rows.append((created_at or datetime.datetime(1970, 1, 1), i, id))
+    rows.sort()
+    return rows
+
+
+# history is already read, so replaying it doesn't count towards unread
+# totals or wake up open streams
+REPLAY_CONFIG = {'feed_count_unread': False, 'feed_notify': False}
+
+
+def clear_feeds():
+    """ Removes every feed entry and the events they point at, along with
+    read positions and unread counts which pointed into the old feeds.
+    Refuses while fan-out jobs are queued, their events would be lost """
+    pending = FanoutJob.query.count()
+    if pending:
+        raise RuntimeError(
+            "{} fan-out jobs are still queued, drain them before rebuilding"
+            .format(pending))
+    FeedEntry.query.delete(synchronize_session=False)
+    FeedArchive.query.delete(synchronize_session=False)
+    FeedState.query.delete(synchronize_session=False)
+    EventRecord.query.delete(synchronize_session=False)
+    db.session.commit()
+
+
+def build_events(rows):
+    """ Builds and stores the events for a chunk of history. Returns a list of
+    (event_id, targets) jobs, targets being [attr, thing_id] pairs like a
+    queued FanoutJob holds """
+    built = []
+    for i, (model, notif_cls) in enumerate(SOURCES):
+        ids = [id for _, source, id in rows if source == i]
+        if not ids:
+            continue
+        objs = dict((obj.id, obj) for obj in
+                    model.query.filter(model.id.in_(ids)))
+        for created_at, source, id in rows:
+            if source == i and id in objs:
+                notif, targets = notif_cls.build(objs[id], time=created_at)
+                db.session.add(notif.record)
+                built.append((notif.record,
+                              [[attr, obj.id] for obj, attr in targets]))
+    db.session.flush()
+    jobs = [(record.id, targets) for record, targets in built]
+    db.session.commit()
+    return jobs
+
+
+def deliver_events(jobs):
+    """ Delivers a slice of jobs, returning how many feed entries were
+    written. Safe to run again on jobs that were partly delivered """
+    written = 0
+    for event_id, targets in jobs:
+        record = EventRecord.query.filter_by(id=event_id).one()
+        event = record.data
+        if event is None:
+            continue
+        event._record = record
+        things = dict((thing.id, thing) for thing in Thing.query.filter(
+            Thing.id.in_([thing_id for _, thing_id in targets])))
+        written += event.send_event(*[(things[thing_id], attr)
+                                      for attr, thing_id in targets
+                                      if thing_id in things])
+    db.session.commit()
+    return written
+
+
+def backfill_subscriptions(chunk=500):
+    """ Redoes the backfill each subscription got when it was made, which
+    replaying the sources' events doesn't reproduce. Returns how many
+    subscriptions were backfilled """
+    done = 0
+    query = (Subscription.query.
+             options(joinedload('subscriber'), joinedload('subscribee')).
+             order_by(Subscription.subscriber_id, Subscription.subscribee_id))
+    while True:
+        subs = query.offset(done).limit(chunk).all()
+        if not subs:
+            break
+        for sub in subs:
+            if not sub.subscribee.fanout_on_read:
+                sub.subscribee.backfill(sub.subscriber, sub.rules)
+        db.session.commit()
+        done += len(subs)
+    return done
+
+
+def _init_worker():
+    # every process gets its own app, and with it its own engine, so no
+    # connections are shared with the parent across the fork
+    from . import create_app
+    db.session.remove()
+    app = create_app()
+    app.config.update(REPLAY_CONFIG)
+    app.app_context().push()
+
+
+def partition(jobs, parts):
+    """ Splits jobs into at most parts interleaved slices """
+    return [jobs[i::parts] for i in range(parts) if jobs[i::parts]]
+
+
+def rebuild_feeds(processes=None, chunk=500, checkpoint='rebuild_feeds.json'):
+    """ Replays history into fresh feeds. Each chunk of history has its
+    events stored by this process, then delivery is partitioned across a
+    pool of processes that each write their share in bulk. Processes of 0
+    delivers inline. Recipients are worked out from subscriptions as they are
+    now, since the history of subscriptions isn't kept, and every
+    subscription gets its backfill again once the replay is done """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    state = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        current_app.logger.info(
+            "Resuming feed rebuild at {}".format(state['position']))
+    else:
+        clear_feeds()
+        state = {'position': 0, 'events': 0, 'entries': 0, 'pending': []}
+
+    def save():
+        if checkpoint:
+            with open(checkpoint, 'w') as f:
+                json.dump(state, f)
+
+    previous = dict((key, current_app.config[key])
+                    for key in REPLAY_CONFIG if key in current_app.config)
+    current_app.config.update(REPLAY_CONFIG)
+    try:
+        _replay(state, save, processes, chunk)
+    finally:
+        for key in REPLAY_CONFIG:
+            current_app.config.pop(key, None)
+        current_app.config.update(previous)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state
+
+
+def _replay(state, save, processes, chunk):
+    """ Builds and delivers whatever of history is left, then redoes the
+    backfills """
+    pool = None
+    if processes:
+        # don't hand open connections down to the forked workers
+        db.session.remove()
+        db.get_engine(current_app).dispose()
+        pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    mapper = pool.map if pool else map
+
+    rows = history()
+    start = time.time()
+    replayed = 0
+    try:
+        while state['pending'] or state['position'] < len(rows):
+            # a chunk whose events were stored but not known to have been
+            # delivered is finished before anything new is built
+            if not state['pending']:
+                chunk_rows = rows[state['position']:
+                                  state['position'] + chunk]
+                state['pending'] = build_events(chunk_rows)
+                state['position'] += len(chunk_rows)
+                state['events'] += len(state['pending'])
+                save()
+
+            jobs = state['pending']
+            parts = partition(jobs, max(processes, 1) * 4)
+            state['entries'] += sum(mapper(deliver_events, parts))
+            state['pending'] = []
+            save()
+
+            replayed += len(jobs)
+            took = time.time() - start
+            current_app.logger.info(
+                "{}/{} replayed, {} entries written, {:.1f} events/s"
+                .format(state['position'], len(rows), state['entries'],
+                        replayed / took if took else 0))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # safe to repeat when resuming, anything already copied is skipped
+    backfill_subscriptions(chunk)
@@ -0,0 +1,204 @@
+""" A cache of the JSON anonymous visitors get for project, task and user
+pages. Every anonymous visitor sees the same page, so it's serialized once
+and then served from a store all uwsgi workers on the host share, a directory
+of files by default. Entries are keyed by the endpoint, id, join profile and
+role set, plus a generation token of the Thing the page is for. The Things
+a transaction touched, as gathered by the flush hook in model_lib, get new
+tokens once it commits, so nothing cached under the old token is served
+again. Changes that only show up on pages further away, such as a project
+being renamed on the pages of its tasks, last until the entry times out """
+from flask import current_app, has_app_context, request
+from flask.ext.login import current_user
+from werkzeug.contrib.cache import FileSystemCache, SimpleCache
+
+import binascii
+import json
+import os
+import sqlalchemy
+import tempfile
+import time
+
+
+# the join profiles anonymous pages are fetched with
+CACHED_JOINS = ('page_join', )
+
+
+def get_store(app=None):
+    """ The store of the app, None when the cache is turned off. 'filesystem'
+    shares entries between the processes of a host, 'simple' keeps them in
+    the process """
+    app = app or current_app
+    if 'response_cache' in app.extensions:
+        return app.extensions['response_cache']
+    backend = app.config.get('response_cache')
+    timeout = app.config.get('response_cache_timeout', 60)
+    if backend == 'filesystem':
+        cache_dir = app.config.get('response_cache_dir') or os.path.join(
+            tempfile.gettempdir(), 'crowdlink_responses')
+        store = FileSystemCache(
+            cache_dir, default_timeout=timeout,
+            threshold=app.config.get('response_cache_threshold', 5000))
+    elif backend == 'simple':
+        store = SimpleCache(
+            default_timeout=timeout,
+            threshold=app.config.get('response_cache_threshold', 5000))
+    else:
+        store = None
+    app.extensions['response_cache'] = store
+    return store
+
+
+class Counters(object):
+    """ The hits, misses and invalidations of one process. They're counted
+    in memory and written every few seconds to a file of the processes own
+    in stats_dir, which isn't part of the cache so nothing expires or prunes
+    them. Without a stats_dir only this process is counted """
+
+    def __init__(self, stats_dir=None, interval=10):
+        self.stats_dir = stats_dir
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        # uwsgi forks workers off after the app is made, each starts afresh
+        self.pid = os.getpid()
+        self.name = '{}-{}.json'.format(self.pid, int(time.time() * 1000))
+        self.counts = dict(hits=0, misses=0, invalidations=0)
+        self.written = time.time()
+
+    def add(self, key, count=1):
+        if os.getpid() != self.pid:
+            self.reset()
+        self.counts[key] += count
+        if time.time() - self.written >= self.interval:
+            self.write()
+
+    def write(self):
+        self.written = time.time()
+        if self.stats_dir is None:
+            return
+        if not os.path.isdir(self.stats_dir):
+            os.makedirs(self.stats_dir)
+        path = os.path.join(self.stats_dir, self.name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.counts, f)
+        os.rename(path + '.tmp', path)
+
+    def totals(self):
+        """ The counts of every process that has written to stats_dir, this
+        one up to date. Processes that have exited are still included """
+        if os.getpid() != self.pid:
+            self.reset()
+        if self.stats_dir is None:
+            return dict(self.counts)
+        self.write()
+        totals = dict.fromkeys(self.counts, 0)
+        for name in os.listdir(self.stats_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.stats_dir, name)) as f:
+                    counts = json.load(f)
+            except (IOError, ValueError):
+                continue
+            for key in totals:
+                totals[key] += counts.get(key, 0)
+        return totals
+
+
+def get_counters(app=None):
+    app = app or current_app
+    counters = app.extensions.get('response_cache_stats')
+    if counters is None:
+        stats_dir = None
+        if app.config.get('response_cache') == 'filesystem':
+            stats_dir = app.config.get('response_cache_stats_dir') or (
+                os.path.join(tempfile.gettempdir(),
+                             'crowdlink_response_stats'))
+        counters = app.extensions['response_cache_stats'] = Counters(
+            stats_dir, app.config.get('response_cache_stats_interval', 10))
+    return counters
+
+
+def _generation(store, thing_id):
+    return store.get('gen:{}'.format(thing_id)) or ''
+
+
+def page_key(endpoint):
+    """ The key the current request is cached under, None if it can't be.
+    Only anonymous fetches of a single object by id with a cached join
+    profile and nothing else qualify """
+    store = get_store()
+    if store is None or endpoint is None:
+        return None
+    if not current_user.is_anonymous():
+        return None
+    args = request.args
+    join = args.get('join_prof')
+    if set(args) != set(['id', 'join_prof']) or join not in CACHED_JOINS:
+        return None
+    try:
+        thing_id = int(args['id'])
+    except ValueError:
+        return None
+    roles = ','.join(sorted(current_user.global_roles()))
+    return 'page:{}:{}:{}:{}:{}'.format(
+        endpoint, thing_id, join, roles, _generation(store, thing_id))
+
+
+def fetch(key):
+    """ The cached body under key, counting the hit or miss """
+    store = get_store()
+    body = store.get(key)
+    get_counters().add('hits' if body is not None else 'misses')
+    return body
+
+
+def store_body(key, body):
+    get_store().set(key, body)
+
+
+def invalidate(thing_ids):
+    """ Gives each Thing a fresh generation token, which outlives anything
+    cached under the token before it """
+    store = get_store()
+    if store is None or not thing_ids:
+        return
+    timeout = current_app.config.get('response_cache_timeout', 60) * 2
+    for thing_id in thing_ids:
+        token = binascii.hexlify(os.urandom(8)).decode('ascii')
+        store.set('gen:{}'.format(thing_id), token, timeout)
+    get_counters().add('invalidations', len(thing_ids))
+
+
+def stats():
+    """ The counts of every process sharing the store since its stats_dir
+    was created. Other processes' counts lag by up to the stats interval """
+    if get_store() is None:
+        return dict(enabled=False)
+    totals = get_counters().totals()
+    hits, misses = totals['hits'], totals['misses']
+    return dict(enabled=True,
+                hit_rate=float(hits) / (hits + misses) if hits + misses else 0,
+                **totals)
+
+
+# Invalidation
+# =============================================================================
+def invalidate_touched(session):
+    """ The Things whose pages a transaction touched go stale once it
+    commits, invalidating any earlier lets a concurrent request cache the old
+    rows again """
+    touched = session.info.pop('touched_things', None)
+    if touched and has_app_context():
+        invalidate(touched)
+
+
+def forget_touched(session):
+    session.info.pop('touched_things', None)
+
+
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_commit',
+                        invalidate_touched)
+sqlalchemy.event.listen(sqlalchemy.orm.Session, 'after_rollback',
+                        forget_touched)
@@ -0,0 +1,217 @@
+""" Live feed updates. Fan-out NOTIFYs each recipient on its own channel in the
+same transaction that writes the feed entries, so Postgres only sends them
+once the entries are committed and readable. Every worker process runs one
+listener that LISTENs to the channels of users with a stream open and hands
+notifications to their queues, the streams then read the new entries back out
+of the feed. Listening and waiting both go through select and threading, so
+under uwsgi's gevent mode with monkey patching they yield instead of tying up
+the worker """
+from flask import current_app
+
+from . import db
+from .model_lib import FeedEntry, decode_cursor, encode_cursor
+
+from six.moves import queue
+from sqlalchemy.orm import joinedload
+
+import json
+import os
+import select
+import sqlalchemy
+import threading
+import time
+
+
+def channel(owner_id):
+    """ The channel a feed owner gets notified on """
+    return 'feed_{}'.format(owner_id)
+
+
+notify_sql = sqlalchemy.text(
+    "SELECT pg_notify('feed_' || owner_id, :payload) "
+    "FROM unnest(CAST(:owner_ids AS INTEGER[])) AS owner_id")
+
+
+def notify(owner_ids, feed, cursor):
+    """ Tells any open streams of the owners that an entry was delivered.
+    Nothing is sent if the transaction rolls back """
+    if not current_app.config.get('feed_notify', True):
+        return
+    db.session.execute(notify_sql, {
+        'owner_ids': list(owner_ids),
+        'payload': json.dumps({'feed': feed, 'cursor': cursor})})
+
+
+class FeedListener(object):
+    """ Holds a connection of its own, outside the pool, that stays LISTENing
+    to the channel of every user with a stream open in this process """
+
+    def __init__(self, engine):
+        fairy = engine.raw_connection()
+        fairy.detach()
+        self.conn = fairy.connection
+        self.conn.autocommit = True
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.thread = None
+        self.running = False
+        self.pid = os.getpid()
+
+    def _execute(self, sql):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(sql)
+            cur.close()
+
+    def subscribe(self, owner_id):
+        """ Returns a queue that gets each notification sent to the owner """
+        q = queue.Queue()
+        with self.lock:
+            queues = self.queues.setdefault(owner_id, set())
+            first = not queues
+            queues.add(q)
+        if first:
+            self._execute('LISTEN "{}"'.format(channel(owner_id)))
+        return q
+
+    def unsubscribe(self, owner_id, q):
+        with self.lock:
+            queues = self.queues.get(owner_id, set())
+            queues.discard(q)
+            last = not queues
+            if last:
+                self.queues.pop(owner_id, None)
+        if last:
+            self._execute('UNLISTEN "{}"'.format(channel(owner_id)))
+
+    def poll(self, timeout=1.0):
+        """ Waits up to timeout for notifications and dispatches them to the
+        queues of their owners. Returns how many were dispatched """
+        ready, _, _ = select.select([self.conn], [], [], timeout)
+        dispatched = 0
+        with self.lock:
+            if ready:
+                self.conn.poll()
+            # notifications can also be picked up while LISTEN runs
+            notifies = list(self.conn.notifies)
+            del self.conn.notifies[:]
+            for notif in notifies:
+                owner_id = int(notif.channel.split('_', 1)[1])
+                for q in self.queues.get(owner_id, ()):
+                    q.put(json.loads(notif.payload))
+                    dispatched += 1
+        return dispatched
+
+    def start(self, app):
+        """ Polls from a daemon thread until stopped """
+        def run():
+            with app.app_context():
+                while self.running:
+                    try:
+                        self.poll()
+                    except Exception:
+                        current_app.logger.error("Feed listener failed",
+                                                 exc_info=True)
+                        self.running = False
+        self.running = True
+        self.thread = threading.Thread(target=run, name='feed-listener')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.conn.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    """ The listener for this process. Started the first time a stream is
+    opened so it's created after uwsgi forks off the worker, and started
+    again if it died """
+    global _listener
+    with _listener_lock:
+        if (_listener is None or _listener.pid != os.getpid() or
+                not _listener.running):
+            app = current_app._get_current_object()
+            _listener = FeedListener(db.get_engine(app))
+            _listener.start(app)
+        return _listener
+
+
+def entries_after(owner_id, feed, cursor, limit=50):
+    """ The entries of a feed newer than cursor, oldest first """
+    entries = (FeedEntry.query.
+               filter_by(owner_id=owner_id, feed=feed).
+               options(joinedload('event')).
+               order_by(FeedEntry.time, FeedEntry.event_id))
+    if cursor is not None:
+        time, event_id = decode_cursor(cursor)
+        entries = entries.filter(
+            sqlalchemy.tuple_(FeedEntry.time, FeedEntry.event_id) >
+            sqlalchemy.tuple_(time, event_id))
+    return entries.limit(limit).all()
+
+
+def newest_cursor(owner_id, feed):
+    entry = (FeedEntry.query.
+             filter_by(owner_id=owner_id, feed=feed).
+             order_by(FeedEntry.time.desc(), FeedEntry.event_id.desc()).
+             first())
+    return entry.cursor if entry else None
+
+
+def event_stream(owner_id, feed, last=None, listener=None, keepalive=15,
+                 duration=50, page=50):
+    """ Generates server-sent events for every entry delivered to the feed.
+    Starts after the cursor last, which EventSource passes back as
+    Last-Event-ID when it reconnects, or from the newest entry. The stream
+    ends after duration seconds so it finishes inside uwsgi's harakiri, the
+    client reconnects and carries on where it left off. The session is let go
+    between reads so an idle stream doesn't hold a database connection """
+    listener = listener or get_listener()
+    q = listener.subscribe(owner_id)
+    try:
+        # anything delivered while the client was away goes out first
+        pending = last is not None
+        if last is None:
+            last = newest_cursor(owner_id, feed)
+        db.session.remove()
+        yield "retry: 2000\n\n"
+        end = time.time() + duration
+        while True:
+            if pending:
+                entries = entries_after(owner_id, feed, last, limit=page)
+                for entry in entries:
+                    event = entry.to_event()
+                    last = entry.cursor
+                    if event is None:
+                        continue
+                    yield "id: {}\nevent: {}\ndata: {}\n\n".format(
+                        last, feed, json.dumps(event.to_json()))
+                db.session.remove()
+                # a full page means there could be more waiting
+                pending = len(entries) == page
+                if pending:
+                    continue
+
+            remaining = end - time.time()
+            if remaining <= 0:
+                break
+            try:
+                notif = q.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if notif.get('feed') == feed:
+                pending = True
+                if last is None:
+                    # the first entry the feed ever got, start just before it
+                    entry_time, event_id = decode_cursor(notif['cursor'])
+                    last = encode_cursor(entry_time, event_id - 1)
+    finally:
+        listener.unsubscribe(owner_id, q)
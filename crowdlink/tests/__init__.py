@@ -73,6 +73,8 @@ class ThinTest(TestCase):
     def setUp(self):
         app = crowdlink.create_app()
         app.config['TESTING'] = True
+        # deliver events inline so tests can inspect feeds right away
+        app.config['fanout_async'] = False
         # Remove flasks stderr handler, replace with stdout so nose can
         # capture properly
         del app.logger.handlers[0]
@@ -1,9 +1,25 @@
 from flask.ext.login import current_user
 from crowdlink.tests import ThinTest
-from crowdlink.models import Project
-from crowdlink.events import TaskNotif
+from crowdlink.models import Project, Task, Comment, User
+from crowdlink.model_lib import (EventRecord, FeedEntry, FanoutJob,
+                                 FeedArchive, Subscription, encode_event,
+                                 decode_event)
+from crowdlink.events import (TaskNotif, drain_fanout, compact_feeds,
+                              dead_fanout_jobs,
+                              migrate_events, migrate_feeds)
+from crowdlink.rebuild import rebuild_feeds
+from crowdlink import model_lib
+from crowdlink.stream import FeedListener, event_stream
+from crowdlink.digest import send_digests, digest_entries
+from lever import get_joined, LeverSyntaxError
 from pprint import pprint
 
+import calendar
+import datetime
+import json
+import os
+import tempfile
+
 
 class EventTests(ThinTest):
 
@@ -69,3 +85,574 @@ class EventTests(ThinTest):
         # the user should now have several events
         for event in current_user.events:
             assert event.origin != project.id
+
+    def test_stored_once(self):
+        """ an event is written once, with one feed entry per recipient """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project()
+        task = self.provision_task(project)
+        project.subscribed = True
+        before = EventRecord.query.count()
+
+        TaskNotif.generate(task)
+        self.db.session.commit()
+
+        assert EventRecord.query.count() == before + 1
+        record = EventRecord.query.order_by(EventRecord.id.desc()).first()
+        entries = FeedEntry.query.filter_by(event_id=record.id).all()
+        # the creators public feed, the projects public feed and the
+        # subscribers private feed
+        assert len(entries) == 3
+        assert user.events[-1].iname == task.title
+        assert user.events[-1].origin == project.id
+
+    def test_fanout_on_read(self):
+        """ subscribers of a popular project merge its feed in on read """
+        self.app.config['fanout_pull_threshold'] = 1
+        owner = self.new_user(username='fred')
+        project = self.provision_project(user=owner)
+        users = [self.new_user(username=name) for name in ['velma', 'shaggy']]
+        for user in users:
+            project.set_subscribed(True, user=user)
+        task = self.provision_task(project)
+
+        record = EventRecord.query.order_by(EventRecord.id.desc()).first()
+        assert project.fanout_on_read is True
+        # nobody got a private copy...
+        assert FeedEntry.query.filter_by(event_id=record.id,
+                                         feed='events').count() == 0
+        # ...but it still shows up in their timelines
+        for user in users:
+            assert user.events[-1].iname == task.title
+            assert user.events[-1].origin == project.id
+            assert user.feed_page('events')[0].iname == task.title
+
+        project.set_subscribed(False, user=users[0])
+        assert len(users[0].events) == 0
+        assert len(users[1].events) == 1
+
+    def test_async_fanout(self):
+        """ creating a task only queues the fanout, the worker delivers it """
+        self.app.config['fanout_async'] = True
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        project.subscribed = True
+        task = self.provision_task(project)
+
+        job = FanoutJob.query.one()
+        assert FeedEntry.query.filter_by(event_id=job.event_id).count() == 0
+
+        assert drain_fanout() == 1
+        assert FanoutJob.query.count() == 0
+        assert user.events[-1].iname == task.title
+        assert project.public_events[-1].iname == task.title
+        # nothing left to do
+        assert drain_fanout() == 0
+
+    def test_async_fanout_retry(self):
+        """ failed jobs get backed off and retried without double delivery """
+        self.app.config['fanout_async'] = True
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        self.provision_task(project)
+        job = FanoutJob.query.one()
+        job.targets = job.targets + [['public_events', -1]]
+        self.db.session.commit()
+
+        assert drain_fanout() == 1
+        job = FanoutJob.query.one()
+        assert job.attempts == 1
+        assert job.error
+        # backed off, so it won't be picked up again right away
+        assert drain_fanout() == 0
+
+        job.targets = job.targets[:-1]
+        job.run_at = job.run_at.replace(year=2000)
+        self.db.session.commit()
+        assert drain_fanout() == 1
+        assert len(project.public_events) == 1
+
+    def test_async_fanout_gives_up(self):
+        """ jobs that keep failing stop being retried and get reported """
+        self.app.config['fanout_async'] = True
+        self.app.config['fanout_max_attempts'] = 2
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        self.provision_task(project)
+        job = FanoutJob.query.one()
+        job.targets = [['public_events', -1]]
+        self.db.session.commit()
+
+        for i in range(2):
+            assert drain_fanout() == 1
+            job = FanoutJob.query.one()
+            job.run_at = job.run_at.replace(year=2000)
+            self.db.session.commit()
+        assert drain_fanout() == 0
+        assert [j.id for j in dead_fanout_jobs()] == [job.id]
+
+    def test_compact_feeds(self):
+        """ entries past the cap get archived but can still be paged to """
+        self.app.config['feed_max_entries'] = {'public_events': 5}
+        self.app.config['feed_retention_days'] = {'public_events': None}
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        for i in range(12):
+            TaskNotif(time=datetime.datetime(2014, 1, 1, 0, i),
+                      iname=str(i)).send_event((project, 'public_events'))
+        self.db.session.commit()
+
+        assert compact_feeds(chunk=3) == 7
+        assert FeedEntry.query.filter_by(owner_id=project.id).count() == 5
+        assert FeedArchive.query.count() == 3
+        assert [e.iname for e in project.public_events] == \
+            [str(i) for i in range(7, 12)]
+
+        names = []
+        cursor = None
+        while True:
+            page = project.feed_page('public_events', before=cursor, limit=4)
+            if not page:
+                break
+            names += [e.iname for e in page]
+            cursor = page[-1].cursor
+        assert names == [str(i) for i in reversed(range(12))]
+        # nothing left to do
+        assert compact_feeds() == 0
+
+        # an entry backfilled with an older time than the archived ones
+        # still gets paged in order
+        TaskNotif(time=datetime.datetime(2014, 1, 1, 0, 5, 30),
+                  iname='late').send_event((project, 'public_events'))
+        page = project.feed_page('public_events', limit=6)
+        assert [e.iname for e in page] == ['11', '10', '9', '8', '7', '6']
+        page = project.feed_page('public_events', before=page[-1].cursor,
+                                 limit=2)
+        assert [e.iname for e in page] == ['late', '5']
+
+    def test_unsubscribe_archived(self):
+        """ unsubscribing removes the sources archived entries too """
+        self.app.config['feed_max_entries'] = {'events': 3}
+        self.app.config['feed_retention_days'] = {'events': None}
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        other = self.provision_project(user=user, name='Other',
+                                       url_key='other')
+        project.subscribed = True
+        other.subscribed = True
+        user.events = None
+        for i in range(8):
+            source = project if i % 2 else other
+            TaskNotif(time=datetime.datetime(2014, 1, 1, 0, i),
+                      iname=str(i)).send_event((source, 'subscribers'))
+        self.db.session.commit()
+        assert compact_feeds(chunk=2) == 5
+
+        project.subscribed = False
+        self.db.session.commit()
+        names = []
+        cursor = None
+        while True:
+            page = user.feed_page('events', before=cursor, limit=2)
+            if not page:
+                break
+            names += [e.iname for e in page]
+            cursor = page[-1].cursor
+        assert names == ['6', '4', '2', '0']
+
+    def test_lazy_feed(self):
+        """ events are only decoded when they're looked at """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        for i in range(3):
+            TaskNotif(time=datetime.datetime(2014, 1, 1, 0, i),
+                      iname=str(i)).send_event((project, 'public_events'))
+        self.db.session.commit()
+        project_id = project.id
+        self.db.session.expunge_all()
+
+        project = Project.query.filter_by(id=project_id).one()
+        # building the feed doesn't read any payloads
+        event_type = model_lib.event_type
+        model_lib.event_type = None
+        try:
+            feed = project.public_events
+            assert len(feed) == 3
+        finally:
+            model_lib.event_type = event_type
+        records = EventRecord.query.all()
+        assert not [r for r in records if getattr(r, '_event', None)]
+        assert feed[-1].iname == '2'
+        assert len([r for r in records if getattr(r, '_event', None)]) == 1
+        feed.append(TaskNotif(time=datetime.datetime(2014, 1, 1, 0, 3),
+                              iname='3'))
+        assert [e.iname for e in feed[1:]] == ['1', '2', '3']
+
+    def test_migrate_events(self):
+        """ events stored as JSON get rewritten in the compact encoding """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        self.provision_task(project)
+        record = EventRecord.query.first()
+        legacy = json.dumps(record.data.to_dict()).encode('utf8')
+        self.db.session.execute(
+            EventRecord.__table__.update().values(data=legacy, cls=None))
+        self.db.session.commit()
+        count = EventRecord.query.count()
+
+        project_id = project.id
+        assert migrate_events(batch=1) == count
+        assert migrate_events() == 0
+        self.db.session.expunge_all()
+        for record in EventRecord.query:
+            assert bytes(record.payload)[:1] != b'{'
+            assert record.event_cls == 'TaskNotif'
+        project = Project.query.filter_by(id=project_id).one()
+        assert project.public_events[-1].iname == 'testing title..'
+
+    def test_compact_round_trip(self):
+        """ the compact encoding gives back exactly what was stored """
+        for compress in (True, False):
+            event = TaskNotif(time=1000, iname=None, uname='velma',
+                              extra='kept')
+            dct = decode_event(encode_event(event, compress=compress)).to_dict()
+            assert dct == event.to_dict()
+            assert 'pname' not in dct
+
+    def test_migrate_feeds(self):
+        """ events in the old per-row columns get copied into the store """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        old = [{'_cls': 'TaskNotif', 'time': 1388534400000, 'iname': 'a'},
+               {'_cls': 'TaskNotif', 'time': 1388534460000, 'iname': 'b',
+                'origin': project.id},
+               {'_cls': 'Gone', 'time': 1388534460000}]
+        self.db.session.execute(
+            'ALTER TABLE "user" ADD COLUMN events TEXT')
+        self.db.session.execute(
+            'ALTER TABLE project ADD COLUMN public_events TEXT')
+        self.db.session.execute(
+            'UPDATE "user" SET events = :val', {'val': json.dumps(old)})
+        self.db.session.execute(
+            'UPDATE project SET public_events = :val',
+            {'val': json.dumps(old[:1])})
+        self.db.session.commit()
+
+        records = EventRecord.query.count()
+        assert migrate_feeds() == 3
+        # the event in both feeds is only stored once
+        assert EventRecord.query.count() == records + 2
+        assert [e.iname for e in user.events] == ['a', 'b']
+        assert user.events[-1].origin == project.id
+        assert project.public_events[0].iname == 'a'
+        assert migrate_feeds() == 0
+
+    def test_unknown_event_skipped(self):
+        """ events stored as a type that no longer exists don't break reads """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        for i in range(2):
+            TaskNotif(time=datetime.datetime(2014, 1, 1, 0, i),
+                      iname=str(i)).send_event((project, 'public_events'))
+        record = EventRecord.query.order_by(EventRecord.id.desc()).first()
+        self.db.session.execute(
+            EventRecord.__table__.update().
+            where(EventRecord.__table__.c.id == record.id).
+            values(data=b'\x01["Gone",0,null]', cls='Gone'))
+        self.db.session.commit()
+        project_id = project.id
+        self.db.session.expunge_all()
+
+        project = Project.query.filter_by(id=project_id).one()
+        assert [e.iname for e in project.public_events] == ['0']
+        assert [e.iname for e in project.feed_page('public_events')] == ['0']
+
+    def test_event_slots(self):
+        """ events carry no instance dict and serialize like get_joined """
+        self.new_user(login_ctx=True, login=True)
+        project = self.provision_project()
+        task = self.provision_task(project)
+        event = project.public_events[-1]
+        assert not hasattr(event, '__dict__')
+        assert event.to_json() == get_joined(event)
+        assert TaskNotif.from_dict(event.to_dict()).to_dict() == \
+            event.to_dict()
+        # keys that aren't declared fields are still kept
+        old = TaskNotif(iname=task.title, gone='still here')
+        assert old.gone == 'still here'
+        assert old.to_dict()['gone'] == 'still here'
+
+    def test_subscribe_backfill(self):
+        """ subscribing copies only the newest events the user doesn't have """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        project.public_events = None
+        for i in range(15):
+            TaskNotif(time=datetime.datetime(2014, 1, 1, 0, i),
+                      iname=str(i)).send_event((project, 'public_events'))
+        user.events = None
+        user.add_event('events', project.public_events[-1])
+        self.db.session.commit()
+
+        project.subscribed = True
+        # ten new ones plus the one they already had, which isn't
+        # delivered twice
+        assert [e.iname for e in user.events] == \
+            [str(i) for i in range(4, 15)]
+
+    def test_comment_as_current_user(self):
+        """ events go out when current_user is passed in as the author """
+        self.new_user(login_ctx=True, login=True)
+        task = self.provision_task(self.provision_project())
+        self.provision_comment(task)
+        assert current_user.public_events[-1].__class__.__name__ == \
+            'NewCommentNotif'
+
+    def test_coalesce_comments(self):
+        """ a burst of comments on a thing reaches its subscribers as one
+        entry, naming everyone who commented """
+        watcher = self.new_user(username='watcher')
+        alice = self.new_user(username='alice')
+        bob = self.new_user(username='bob')
+        task = self.provision_task(self.provision_project(user=watcher))
+        task.set_subscribed(True, user=watcher)
+        self.db.session.commit()
+        for user, message in [(alice, 'one'), (bob, 'two'), (alice, 'three')]:
+            Comment.create(thing=task, user=user, message=message)
+            self.db.session.commit()
+
+        comments = [e for e in watcher.events
+                    if e.__class__.__name__ == 'NewCommentNotif']
+        assert len(comments) == 1
+        assert comments[0].uname == 'alice'
+        assert comments[0].others == ['bob']
+        assert comments[0].to_json()['other_unames'] == ['bob']
+        assert comments[0].message.startswith('three')
+        # the commenters own feeds still get each of their comments
+        assert [e.message[:3] for e in bob.public_events] == ['two']
+        # merging never rewrites what the commenter was delivered
+        assert ([(e.uname, e.message[:3]) for e in alice.public_events] ==
+                [('alice', 'one'), ('alice', 'thr')])
+        assert alice.public_events[0].other_unames == []
+        # a comment that was never merged serializes with nobody else
+        assert get_joined(bob.public_events[0])['other_unames'] == []
+
+        # nothing is merged with the window turned off
+        self.app.config['coalesce_window'] = 0
+        Comment.create(thing=task, user=bob, message='four')
+        self.db.session.commit()
+        assert len([e for e in watcher.events
+                    if e.__class__.__name__ == 'NewCommentNotif']) == 2
+
+    def test_coalesce_respects_rules(self):
+        """ a comment isn't merged into an entry reaching a subscriber whose
+        rules drop it """
+        watcher = self.new_user(username='watcher')
+        muter = self.new_user(username='muter')
+        alice = self.new_user(username='alice')
+        bob = self.new_user(username='bob')
+        task = self.provision_task(self.provision_project(user=watcher))
+        task.set_subscribed(True, user=watcher)
+        task.set_subscribed(True, user=muter, rules={'mute_user:bob': ''})
+        self.db.session.commit()
+        for user, message in [(alice, 'one'), (bob, 'two')]:
+            Comment.create(thing=task, user=user, message=message)
+            self.db.session.commit()
+
+        def comments(user):
+            return [(e.uname, e.message[:3]) for e in user.events
+                    if e.__class__.__name__ == 'NewCommentNotif']
+        assert comments(watcher) == [('alice', 'one'), ('bob', 'two')]
+        assert comments(muter) == [('alice', 'one')]
+
+    def test_subscription_rules(self):
+        """ subscribers whose rules drop an event never get it written """
+        users = [self.new_user(username=name)
+                 for name in ('velma', 'muter', 'picky', 'alice', 'bob')]
+        velma, muter, picky, alice, bob = users
+        task = self.provision_task(self.provision_project(user=velma))
+        task.set_subscribed(True, user=velma)
+        task.set_subscribed(True, user=muter, rules={'mute_user:bob': ''})
+        task.set_subscribed(True, user=picky, rules={'min_votes': '1'})
+        self.app.config['coalesce_window'] = 0
+        self.db.session.commit()
+        Comment.create(thing=task, user=alice, message='one')
+        Comment.create(thing=task, user=bob, message='two')
+        self.db.session.commit()
+
+        def comments(user):
+            return [e.uname for e in user.events
+                    if e.__class__.__name__ == 'NewCommentNotif']
+        assert comments(velma) == ['alice', 'bob']
+        assert comments(muter) == ['alice']
+        assert comments(picky) == []
+
+        # the same rules compiled for reading
+        event = velma.events[-1]
+        assert event.sendable(None)
+        assert not event.sendable({'mute_user:bob': ''})
+        assert not event.sendable({'mute_event:NewCommentNotif': ''})
+        assert not event.sendable({'min_votes': '1'})
+
+        sub = Subscription()
+        with self.assertRaises(ValueError):
+            sub.rules = {'bogus': ''}
+        with self.assertRaises(ValueError):
+            sub.rules = {'min_votes': 'lots'}
+
+    def test_unread_count(self):
+        """ fan-out counts what's unread, marking the feed seen resets it """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        project.subscribed = True
+        self.db.session.commit()
+        assert user.feed_state('events').unread == 0
+        for i in range(3):
+            Task.create(title='task {}'.format(i), project=project, user=user)
+        assert user.feed_state('events').unread == 3
+
+        events = user.feed_page('events')
+        state = user.mark_seen('events', before=events[1].cursor)
+        assert state.unread == 1
+        assert state.seen == events[1].cursor
+        state = user.mark_seen('events')
+        assert state.unread == 0
+        assert state.seen == events[0].cursor
+        self.db.session.commit()
+        Task.create(title='task 3', project=project, user=user)
+        assert user.feed_state('events').unread == 1
+
+    def test_digests(self):
+        """ digests go out once a period and pick up after the last one """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        project.subscribed = True
+        for i in range(2):
+            Task.create(title='task {}'.format(i), project=project, user=user)
+        self.db.session.commit()
+
+        now = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        assert send_digests(now=now) == 1
+        assert user.digest_time == now
+        assert user.digest_cursor == user.feed_page('events')[0].cursor
+        # not due again until a day has passed
+        Task.create(title='task 2', project=project, user=user)
+        self.db.session.commit()
+        assert send_digests(now=now + datetime.timedelta(hours=1)) == 0
+
+        later = now + datetime.timedelta(days=1)
+        entries, total = digest_entries(user, later, 20)
+        assert total == 1
+        assert entries[0].to_event().iname == 'task 2'
+        assert send_digests(now=later) == 1
+        assert user.digest_cursor == user.feed_page('events')[0].cursor
+        # nothing new still pushes the next check back a period
+        assert send_digests(now=later + datetime.timedelta(days=1)) == 0
+        assert user.digest_time == later + datetime.timedelta(days=1)
+
+        user.digest = 'never'
+        Task.create(title='task 3', project=project, user=user)
+        self.db.session.commit()
+        assert send_digests(now=later + datetime.timedelta(days=30)) == 0
+        with self.assertRaises(LeverSyntaxError):
+            user.digest = 'hourly'
+
+    def test_stream(self):
+        """ entries delivered to a feed get pushed to its open streams once
+        they're committed, and a reconnect picks up where it left off """
+        user = self.new_user(login_ctx=True, login=True)
+        project = self.provision_project(user=user)
+        project.subscribed = True
+        self.db.session.commit()
+        user_id, project_id = user.id, project.id
+
+        listener = FeedListener(self.db.get_engine(self.app))
+        listener.start(self.app)
+        try:
+            events = event_stream(user_id, 'events', listener=listener,
+                                  keepalive=0.1, duration=10)
+            assert next(events).startswith('retry')
+            # the stream let go of the session
+            project = Project.query.filter_by(id=project_id).one()
+            Task.create(title='live', project=project,
+                        user=User.query.filter_by(id=user_id).one())
+            self.db.session.commit()
+            chunk = next(events)
+            while chunk.startswith(':'):
+                chunk = next(events)
+            assert 'event: events' in chunk
+            assert '"iname": "live"' in chunk
+            cursor = chunk.split('\n')[0][len('id: '):]
+            events.close()
+            assert not listener.queues
+
+            Task.create(title='missed', project=project,
+                        user=User.query.filter_by(id=user_id).one())
+            self.db.session.commit()
+            events = event_stream(user_id, 'events', last=cursor,
+                                  listener=listener, keepalive=0.1,
+                                  duration=1)
+            chunks = [c for c in events if c.startswith('id:')]
+            assert len(chunks) == 1
+            assert '"iname": "missed"' in chunks[0]
+        finally:
+            listener.stop()
+
+    def test_rebuild_refuses_queued(self):
+        """ a rebuild won't throw away events still waiting on fan-out """
+        user = self.new_user()
+        self.app.config['fanout_async'] = True
+        Project.create('Crowdlink', 'crowdlink', user=user)
+        self.db.session.commit()
+        assert FanoutJob.query.count() == 1
+        with self.assertRaises(RuntimeError):
+            rebuild_feeds(processes=0, checkpoint=None)
+        self.db.session.rollback()
+        assert FanoutJob.query.count() == 1
+
+    def test_rebuild_feeds(self):
+        """ replaying history gives back the same feeds, stamping events with
+        when their object was created """
+        user = self.new_user(login_ctx=True, login=True)
+        project = Project.create('Crowdlink', 'crowdlink', user=user)
+        self.db.session.commit()
+        project.subscribed = True
+        task = self.provision_task(project)
+        self.provision_comment(task)
+        self.db.session.commit()
+
+        def feeds():
+            return [sorted(e.__class__.__name__ for e in events) for events in
+                    (user.events, user.public_events, project.public_events)]
+        before = feeds()
+        assert 'TaskNotif' in before[0]
+
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'rebuild.json')
+        state = rebuild_feeds(processes=2, chunk=1, checkpoint=checkpoint)
+        assert state['events'] == 3
+        assert not os.path.exists(checkpoint)
+        # the session was dropped before forking the pool
+        user = self.db.session.merge(user)
+        project = self.db.session.merge(project)
+        assert feeds() == before
+        # replayed history isn't unread
+        assert user.feed_state('events').unread == 0
+        times = dict((e.__class__.__name__, e.time)
+                     for e in project.public_events)
+        assert times['NewProjNotif'] == calendar.timegm(
+            project.created_at.utctimetuple()) * 1000
+
+        # resuming finishes the chunk that was pending and nothing else
+        pending = [(EventRecord.query.order_by(EventRecord.id).first().id,
+                    [['public_events', project.id]])]
+        FeedEntry.query.delete()
+        self.db.session.commit()
+        with open(checkpoint, 'w') as f:
+            json.dump({'position': 3, 'events': 3, 'entries': 0,
+                       'pending': pending}, f)
+        state = rebuild_feeds(processes=0, checkpoint=checkpoint)
+        assert state['entries'] == 1
+        assert self.app.config.get('feed_notify', True)
+        assert user.feed_state('events').unread == 0
+        # and the subscriber gets it backfilled
+        assert FeedEntry.query.count() == 2
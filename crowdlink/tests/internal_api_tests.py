@@ -1,9 +1,13 @@
 from flask.ext.login import current_user, logout_user
 
 from crowdlink.tests import ThinTest
-from crowdlink.models import Project, Email, User
+from crowdlink.models import Project, Task, Email, User
+from crowdlink.model_lib import (request_cached, clear_acl_cache,
+                                  Membership)
+from crowdlink.acl import acl
 
 import datetime
+import sqlalchemy
 
 
 class ProjectTests(ThinTest):
@@ -111,3 +115,138 @@ class UserTests(ThinTest):
                  ('dsfglkj', False)]
         for username, result in tests:
             assert User.check_taken(username)['taken'] is result
+
+
+class ACLTests(ThinTest):
+    def test_compiled_matches_sets(self):
+        """ every combination of two roles allows the same actions compiled
+        as it does unioning the role sets """
+        for typ, compiled in acl.items():
+            roles = list(compiled.keys()) + ['bogus']
+            for first in roles:
+                for second in roles:
+                    allowed = (compiled.get(first, set()) |
+                               compiled.get(second, set()))
+                    mask = compiled.mask([first, second])
+                    assert compiled.allowed(mask) == allowed
+                    for action in compiled.actions:
+                        assert (compiled.permits([first, second], action) is
+                                (action in allowed))
+            assert not compiled.permits(roles, 'not_an_action')
+
+    def test_user_acl(self):
+        """ the models checks go through the compiled masks """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        assert project.can('action_add_maintainer')
+        keys = project.user_acl()
+        assert isinstance(keys, set)
+        assert 'action_add_maintainer' in keys
+        # callers get their own copy
+        keys.add('bogus')
+        assert 'bogus' not in project.user_acl()
+        assert Project.can_cls('action_create')
+
+    def test_roles_cached(self):
+        """ a projects roles are worked out once for all of its tasks, until
+        something gets written """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        tasks = [Task.create(title='task {}'.format(i), project=project,
+                             user=user) for i in range(10)]
+        self.db.session.commit()
+
+        calls = []
+        roles = Project.roles
+
+        def counted(self, user=current_user):
+            calls.append(self)
+            return ['owner']
+        Project.roles = request_cached(counted)
+        try:
+            for task in tasks:
+                assert 'project_owner' in task.roles()
+                assert task.can('edit_title')
+            assert len(calls) == 1
+            # callers can't change what's cached
+            task.roles().append('bogus')
+            assert 'bogus' not in task.roles()
+            self.db.session.commit()
+            tasks[0].roles()
+            assert len(calls) == 2
+        finally:
+            Project.roles = roles
+
+    def test_roles_invalidated(self):
+        """ roles changed by a write in the same request are seen """
+        user = self.new_user(login_ctx=True)
+        other = self.new_user(username='scooby')
+        project = self.provision_project(user=user)
+        assert project.roles(user=user) == ['owner']
+        assert project.roles(user=other) == []
+        project.owner = other
+        self.db.session.flush()
+        assert project.roles(user=other) == ['owner']
+        assert not project.can('action_add_maintainer', user=user)
+
+    def test_bulk_user_acl(self):
+        """ a list of tasks costs a query per group, not per task, and gets
+        the same acls as working them out one by one """
+        user = self.new_user(login_ctx=True)
+        other = self.new_user(username='scooby')
+        project = self.provision_project(user=other)
+        for i in range(10):
+            Task.create(title='task {}'.format(i), project=project,
+                        user=other if i % 2 else user)
+        self.db.session.commit()
+        tasks = Task.query.all()
+        user.global_roles()
+        clear_acl_cache()
+
+        queries = []
+
+        def count(*args):
+            queries.append(args[2])
+        engine = self.db.get_engine(self.app)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            acls = Task.bulk_user_acl(tasks, user=user)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        # the project once for each of the creator and non creator groups,
+        # and the users membership of it
+        assert len(queries) == 3, queries
+        # later checks are served from what the bulk call left behind
+        assert [task.user_acl(user=user) for task in tasks] == acls
+
+        clear_acl_cache()
+        assert [task.user_acl(user=user) for task in tasks] == acls
+        assert len(set(frozenset(acl) for acl in acls)) == 2
+
+    def test_maintainer_roles(self):
+        """ maintainers get their role from the membership table, and lose it
+        when removed """
+        user = self.new_user(login_ctx=True)
+        other = self.new_user(username='scooby')
+        project = self.provision_project(user=user)
+        task = Task.create(title='task', project=project, user=user)
+        self.db.session.commit()
+        assert project.roles(user=user) == ['owner']
+        assert project.roles(user=other) == []
+        assert not task.can('edit_title', user=other)
+
+        project.add_maintainer('scooby')
+        self.db.session.commit()
+        assert project.roles(user=other) == ['maintainer']
+        assert 'project_maintainer' in task.roles(user=other)
+        assert task.can('edit_title', user=other)
+        assert not project.can('action_add_maintainer', user=other)
+        acls = Project.bulk_user_acl([project], user=other)
+        clear_acl_cache()
+        assert acls == [project.user_acl(user=other)]
+
+        project.remove_maintainer('scooby')
+        self.db.session.commit()
+        assert project.roles(user=other) == []
+        assert Membership.query.filter_by(user_id=other.id).count() == 0
+        assert not task.can('edit_title', user=other)
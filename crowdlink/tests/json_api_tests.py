@@ -1,8 +1,16 @@
 from crowdlink.tests import ThinTest
 from crowdlink.models import Task, Project, User, Comment
 
+from crowdlink import serialize, response_cache
 from lever import jsonize
 
+import json
+import lever.base
+import os
+import shutil
+import sqlalchemy
+import tempfile
+
 
 class TestMixinsJSONAPI(ThinTest):
     def test_voting(self):
@@ -119,3 +127,293 @@ class TestAnonymousPermissions(ThinTest):
         self.provision_many(user=fred)
         self.new_user(login_ctx=True, active=False)
         self.change_attr_fails()
+
+
+class TestFeedAPI(ThinTest):
+    def test_feed_pages(self):
+        """ can i walk back through a feed with cursors? """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        urls = []
+        for i in range(5):
+            task = Task.create(title='task {}'.format(i),
+                               project=project,
+                               user=user)
+            self.db.session.commit()
+            urls.append(task.get_dur_url)
+
+        seen = []
+        params = {'id': project.id, 'feed': 'public_events', 'pg_size': 2}
+        while True:
+            ret = self.get('/api/feed', 200, params=dict(params))
+            assert len(ret['objects']) <= 2
+            seen += [obj['task_p'] for obj in ret['objects']]
+            if ret['cursor'] is None:
+                break
+            params['before'] = ret['cursor']
+        # newest first, nothing skipped or repeated
+        assert seen == list(reversed(urls))
+
+    def test_private_feed_denied(self):
+        """ can't read someone elses private feed """
+        fred = self.new_user(username='fred')
+        self.new_user(login_ctx=True)
+        self.get('/api/feed', 403, params={'id': fred.id, 'feed': 'events'})
+        self.get('/api/feed', 200, params={'id': fred.id,
+                                           'feed': 'public_events'})
+
+    def test_unread(self):
+        """ can i poll the unread count and mark my feed read? """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        project.set_subscribed(True, user=user)
+        self.db.session.commit()
+        for i in range(2):
+            Task.create(title='task {}'.format(i), project=project, user=user)
+            self.db.session.commit()
+        ret = self.get('/api/user/unread', 200)
+        assert ret['unread'] == 2
+        assert ret['seen'] is None
+        ret = self.post('/api/user/unread', 200)
+        assert ret['unread'] == 0
+        assert ret['seen'] is not None
+        assert self.get('/api/user/unread', 200)['unread'] == 0
+        self.post('/api/user/unread', 400, params={'before': 'garbage'},
+                  success=False)
+
+    def test_bad_cursor(self):
+        self.new_user(login_ctx=True)
+        self.get('/api/feed', 400, params={'before': 'garbage'})
+        self.get('/api/feed', 400,
+                 params={'before': '99999999999999999999_1'})
+        self.get('/api/feed', 400,
+                 params={'before': '-99999999999999999999_1'})
+        self.get('/api/feed', 400, params={'before': '0_99999999999'})
+        self.get('/api/feed', 400, params={'id': 'abc'})
+        self.app.config['feed_stream_enabled'] = True
+        self.get('/api/feed/stream', 400,
+                 headers={'Last-Event-ID': 'garbage'})
+
+    def test_stream_disabled(self):
+        """ streams hold a worker each, they're off unless turned on """
+        self.new_user(login_ctx=True)
+        self.get('/api/feed/stream', 404, success=False)
+
+
+class QueryCountTest(ThinTest):
+    def count_get(self, uri, params):
+        queries = []
+
+        def count(*args):
+            queries.append(args[2])
+        engine = self.db.get_engine(self.app)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            self.get(uri, 200, params=params)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        return len(queries)
+
+
+class TestJoinQueries(QueryCountTest):
+    def test_task_page_queries(self):
+        """ a task page costs the same number of queries however many
+        comments, and commenters, it has """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        task_id = Task.create(title='task', project=project, user=user).id
+        self.db.session.commit()
+        counts = []
+        for i in range(3):
+            task = Task.query.get(task_id)
+            for j in range(5):
+                commenter = self.new_user(username='user{}_{}'.format(i, j))
+                Comment.create('comment', task, user=commenter)
+            self.db.session.commit()
+            self.db.session.expunge_all()
+            counts.append(self.count_get(
+                '/api/task', {'id': task_id, 'join_prof': 'page_join'}))
+        assert counts[0] == counts[1] == counts[2], counts
+
+    def test_project_page_queries(self):
+        """ the tasks and maintainers on a project page are fetched in
+        bulk, as is a page of tasks """
+        # anonymously, a logged in user's vote and subscription state on each
+        # task are still looked up one by one
+        user = self.new_user()
+        project_id = self.provision_project(user=user).id
+        self.db.session.commit()
+        page_counts = []
+        list_counts = []
+        for i in range(3):
+            project = Project.query.get(project_id)
+            for j in range(5):
+                Task.create(title='task {} {}'.format(i, j), project=project,
+                            user=project.owner)
+            maintainer = self.new_user(username='maint{}'.format(i))
+            project.add_maintainer(maintainer.username)
+            self.db.session.commit()
+            self.db.session.expunge_all()
+            page_counts.append(self.count_get(
+                '/api/project', {'id': project_id, 'join_prof': 'page_join'}))
+            self.db.session.expunge_all()
+            list_counts.append(self.count_get(
+                '/api/task', {'join_prof': 'standard_join'}))
+        assert page_counts[0] == page_counts[1] == page_counts[2], page_counts
+        assert list_counts[0] == list_counts[1] == list_counts[2], list_counts
+
+
+class TestResponseCache(QueryCountTest):
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.app.config['response_cache'] = 'filesystem'
+        self.app.config['response_cache_dir'] = os.path.join(
+            cache_dir, 'pages')
+        self.app.config['response_cache_stats_dir'] = os.path.join(
+            cache_dir, 'stats')
+
+    def test_anonymous_page_cached(self):
+        """ an anonymous task page is served from the cache until a comment
+        on the task is committed """
+        user = self.new_user()
+        project = self.provision_project(user=user)
+        task = Task.create(title='task', project=project, user=user)
+        task_id = task.id
+        self.db.session.commit()
+        params = {'id': task_id, 'join_prof': 'page_join'}
+
+        assert self.count_get('/api/task', params) > 0
+        assert self.count_get('/api/task', params) == 0
+
+        Comment.create('new comment', Task.query.get(task_id), user=user)
+        self.db.session.commit()
+        assert self.count_get('/api/task', params) > 0
+        res = self.get('/api/task', 200, params=params)
+        assert res['objects'][0]['comments'][0]['message'] == 'new comment'
+
+        # other join profiles aren't cached
+        params['join_prof'] = 'standard_join'
+        assert self.count_get('/api/task', params) > 0
+        assert self.count_get('/api/task', params) > 0
+
+        stats = self.get('/api/metrics/response_cache', 200)
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        assert stats['hit_rate'] == 0.5
+
+        # counts outlive the cache entries, and add up across processes
+        self.app.extensions['response_cache'].clear()
+        other = response_cache.Counters(
+            self.app.config['response_cache_stats_dir'])
+        other.name = 'other.json'
+        other.add('hits', 3)
+        other.write()
+        stats = self.get('/api/metrics/response_cache', 200)
+        assert stats['hits'] == 5
+        assert stats['misses'] == 2
+
+    def test_logged_in_not_cached(self):
+        user = self.new_user(login_ctx=True)
+        project_id = self.provision_project(user=user).id
+        self.db.session.commit()
+        params = {'id': project_id, 'join_prof': 'page_join'}
+        self.count_get('/api/project', params)
+        assert self.count_get('/api/project', params) > 0
+
+
+class TestETags(ThinTest):
+    def conditional_get(self, uri, params, etag=None):
+        headers = {'If-None-Match': '"{}"'.format(etag)} if etag else {}
+        return self.client.get(uri, query_string=params, headers=headers)
+
+    def test_not_modified(self):
+        """ a page is answered with a 304 until something on it changes """
+        user = self.new_user(login_ctx=True)
+        project = self.provision_project(user=user)
+        task_id = Task.create(title='task', project=project, user=user).id
+        self.db.session.commit()
+        params = {'id': task_id, 'join_prof': 'page_join'}
+
+        res = self.conditional_get('/api/task', params)
+        assert res.status_code == 200
+        etag = res.get_etag()[0]
+        assert etag
+
+        res = self.conditional_get('/api/task', params, etag)
+        assert res.status_code == 304
+        assert not res.data
+
+        Comment.create('new comment', Task.query.get(task_id), user=user)
+        self.db.session.commit()
+        res = self.conditional_get('/api/task', params, etag)
+        assert res.status_code == 200
+        assert res.get_etag()[0] != etag
+
+    def test_versions_bumped(self):
+        """ a Thing's version moves when it or its children are written """
+        user = self.new_user()
+        project = self.provision_project(user=user)
+        self.db.session.commit()
+        version = project.version
+        task = Task.create(title='task', project=project, user=user)
+        self.db.session.commit()
+        assert project.version > version
+        version = task.version
+        Comment.create('new comment', task, user=user)
+        self.db.session.commit()
+        assert task.version > version
+
+    def test_unversioned_join(self):
+        user = self.new_user(login_ctx=True)
+        self.db.session.commit()
+        res = self.conditional_get(
+            '/api/user', {'id': user.id, 'join_prof': 'home_join'})
+        assert res.status_code == 200
+        assert res.get_etag() == (None, None)
+
+
+class TestSerializers(ThinTest):
+    def test_compiled_matches_lever(self):
+        """ the compiled serializers give what lever's get_joined does for
+        every profile of every model """
+        user = self.new_user(login_ctx=True, login=True)
+        self.provision_many(user=user)
+        project = Project.query.first()
+        project.subscribed = True
+        task = Task.create(title='another', project=project, user=user)
+        Comment.create('a comment', task, user=user)
+        self.db.session.commit()
+
+        objs = [user, project, task, Comment.query.first(), user.emails[0]]
+        # lever recurses through the patched name, put its own back so the
+        # reference is reflection all the way down
+        lever.base.get_joined = serialize._reflect
+        compared = []
+        try:
+            for obj in objs:
+                for name in dir(obj.__class__):
+                    if not (name.endswith('_join') and
+                            isinstance(getattr(obj.__class__, name), list)):
+                        continue
+                    try:
+                        expected = serialize._reflect(obj, name)
+                    except Exception as e:
+                        with self.assertRaises(type(e)):
+                            serialize.get_joined(obj, name)
+                        continue
+                    lever.base.get_joined = serialize.get_joined
+                    try:
+                        got = serialize.get_joined(obj, name)
+                    finally:
+                        lever.base.get_joined = serialize._reflect
+                    assert (json.dumps(got, sort_keys=True, default=str) ==
+                            json.dumps(expected, sort_keys=True,
+                                       default=str)), (obj, name)
+                    compared.append((obj.__class__.__name__, name))
+        finally:
+            lever.base.get_joined = serialize.get_joined
+        for obj, name in [('Project', 'page_join'), ('Task', 'page_join'),
+                          ('User', 'home_join'), ('User', 'page_join')]:
+            assert (obj, name) in compared
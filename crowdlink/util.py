@@ -1,3 +1,5 @@
+import calendar
+import datetime
 import six
 
 def flatten(tpl):
@@ -28,6 +30,17 @@ def flatten_dict(dct):
     return {key: flatten(value) for (key, value) in six.iteritems(dct)}
 
 
+def jsonable(val):
+    """ Converts an attribute value the same way lever's jsonize does """
+    if isinstance(val, datetime.datetime):
+        return calendar.timegm(val.utctimetuple()) * 1000
+    if val is None or isinstance(val, (bool, int, dict, list)):
+        return val
+    if isinstance(val, set):
+        return dict((x, True) for x in val)
+    return str(val)
+
+
 def inherit_dict(*args):
     """ Joines together multiple dictionaries left to right """
     ret = {}
@@ -1,3 +1,13 @@
+try:
+    from gevent import monkey
+    from psycogreen.gevent import patch_psycopg
+except ImportError:
+    pass
+else:
+    # running under uwsgi's gevent mode, make database waits yield too
+    if monkey.is_module_patched('socket'):
+        patch_psycopg()
+
 from . import create_app
 
 app = create_app()
@@ -5,6 +5,7 @@ app = create_app()
 manager = Manager(app)
 
 import os
+import time
 import sqlalchemy
 
 from crowdlink.mail import TestEmail
@@ -39,6 +40,168 @@ def test_email(template=None):
     TestEmail().send_email(recipient)
 
 
+@manager.command
+def fanout_worker(interval=1.0, batch=100):
+    """ Drains the event fanout queue until killed """
+    from crowdlink.events import drain_fanout
+    while True:
+        if not drain_fanout(batch=int(batch)):
+            time.sleep(float(interval))
+
+
+@manager.command
+def fanout_failures(requeue=False):
+    """ Lists fanout jobs that ran out of attempts, optionally requeueing """
+    from crowdlink.events import dead_fanout_jobs
+    for job in dead_fanout_jobs():
+        print("Job {} event {}: {}".format(job.id, job.event_id, job.error))
+        if requeue:
+            job.attempts = 0
+    db.session.commit()
+
+
+@manager.command
+def compact_feeds(batch=100, chunk=200):
+    """ Archives feed entries past their feeds cap or retention """
+    from crowdlink.events import compact_feeds
+    archived = compact_feeds(batch=int(batch), chunk=int(chunk))
+    print("Archived {} feed entries".format(archived))
+
+
+@manager.command
+def rebuild_feeds(processes=None, chunk=500, checkpoint='rebuild_feeds.json'):
+    """ Regenerates all feeds from project, task and comment history """
+    from crowdlink.rebuild import rebuild_feeds
+    if processes is not None:
+        processes = int(processes)
+    state = rebuild_feeds(processes=processes, chunk=int(chunk),
+                          checkpoint=checkpoint)
+    print("Replayed {} events into {} feed entries"
+          .format(state['events'], state['entries']))
+
+
+@manager.command
+def migrate_feeds(batch=500):
+    """ Moves events out of the old per-row columns into the event store """
+    from crowdlink.events import migrate_feeds
+    done = migrate_feeds(batch=int(batch))
+    print("Copied {} feed entries".format(done))
+
+
+@manager.command
+def index_subscription_rules():
+    """ Adds the GIN index on subscription rules to an existing database """
+    exists = db.session.execute(
+        "SELECT 1 FROM pg_indexes "
+        "WHERE indexname = 'ix_subscription_rules'").scalar()
+    if not exists:
+        db.session.execute("CREATE INDEX ix_subscription_rules "
+                           "ON subscription USING gin (rules)")
+        db.session.commit()
+        print("Indexed subscription rules")
+
+
+@manager.command
+def migrate_memberships():
+    """ Creates the membership table and fills it from project owners and
+    maintainers """
+    from crowdlink.model_lib import Membership
+    Membership.__table__.create(db.engine, checkfirst=True)
+    db.session.execute(
+        "INSERT INTO membership (thing_id, user_id, roles) "
+        "SELECT project.id, \"user\".id, ARRAY['owner'] FROM project "
+        "JOIN \"user\" ON \"user\".username = project.owner_username "
+        "ON CONFLICT DO NOTHING")
+    db.session.execute(
+        "INSERT INTO membership (thing_id, user_id, roles) "
+        "SELECT project_id, user_id, ARRAY['maintainer'] "
+        "FROM project_maintainer "
+        "ON CONFLICT (thing_id, user_id) DO UPDATE "
+        "SET roles = array_append(array_remove(membership.roles, "
+        "'maintainer'), 'maintainer')")
+    db.session.commit()
+
+
+@manager.command
+def send_digests(batch=100):
+    """ Emails a digest of their feed to every user due one """
+    from crowdlink.digest import send_digests
+    sent = send_digests(batch=int(batch))
+    print("Sent {} digests".format(sent))
+
+
+@manager.command
+def migrate_fanout():
+    """ Adds the fan-out mode flag to an existing thing table """
+    db.session.execute(
+        "ALTER TABLE thing "
+        "ADD COLUMN IF NOT EXISTS fanout_on_read BOOLEAN DEFAULT false")
+    db.session.commit()
+
+
+@manager.command
+def migrate_digests():
+    """ Adds the digest preference columns to an existing user table """
+    db.session.execute(
+        'ALTER TABLE "user" '
+        "ADD COLUMN IF NOT EXISTS digest VARCHAR(8) DEFAULT 'daily', "
+        "ADD COLUMN IF NOT EXISTS digest_time TIMESTAMP WITHOUT TIME ZONE, "
+        "ADD COLUMN IF NOT EXISTS digest_cursor VARCHAR")
+    db.session.commit()
+
+
+@manager.command
+def migrate_versions():
+    """ Adds the version counter to an existing thing table """
+    db.session.execute(
+        "ALTER TABLE thing "
+        "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0")
+    db.session.commit()
+
+
+@manager.command
+def migrate_events(batch=1000):
+    """ Rewrites stored events in the compact encoding """
+    from crowdlink.events import migrate_events
+    done = migrate_events(batch=int(batch))
+    print("Rewrote {} events".format(done))
+
+
+@manager.command
+def bench_events(count=10000, rounds=5):
+    """ Compares stored event size and decode speed across encodings """
+    from crowdlink.bench import bench_event_encoding
+    bench_event_encoding(count=int(count), rounds=int(rounds))
+
+
+@manager.command
+def bench_event_objects(count=10000, rounds=5):
+    """ Compares decoded event memory and serialization speed """
+    from crowdlink.bench import bench_event_objects
+    bench_event_objects(count=int(count), rounds=int(rounds))
+
+
+@manager.command
+def bench_delivery(subscribers=10000, rounds=5):
+    """ Times event delivery to a project with many subscribers """
+    from crowdlink.bench import bench_delivery
+    bench_delivery(subscribers=int(subscribers), rounds=int(rounds))
+
+
+@manager.command
+def bench_acl(checks=100000, rounds=5):
+    """ Times permission checks against the compiled ACL """
+    from crowdlink.bench import bench_acl
+    bench_acl(checks=int(checks), rounds=int(rounds))
+
+
+@manager.command
+def bench_serializers(count=10000, rounds=5):
+    """ Times serializing tasks with lever against the compiled serializers """
+    from crowdlink.bench import bench_serializers
+    bench_serializers(count=int(count), rounds=int(rounds))
+
+
 @manager.command
 def runserver():
     current_app.run(debug=True, host='0.0.0.0')